@@ -1,137 +1,112 @@
 #create sales order from shopify
+import base64
+import hashlib
+import hmac
+
 import frappe
 from frappe.utils import getdate
+from frappe.utils.password import get_decrypted_password
+
+from divyam.order_ledger import claim_orders, mark_created, mark_existing, mark_failed, record_received
+from divyam.shopify import (
+    create_missing_items, get_currency_settings, get_existing_order_ids, get_or_create, get_store, save_snapshots,
+)
+from divyam.shopify_transform import build_sales_order
 @frappe.whitelist(allow_guest=True)
-def create_order(data):
+def create_order(data, shop_url=None):
+    # Only store the payload and queue the work so the webhook answers before
+    # Shopify's timeout; repeated deliveries of one order share a single job.
+    # Shopify names the sending shop in a header, which picks the store the
+    # order is created for, and signs the body with that store's secret;
+    # without a request the first store is used.
+    if frappe.request:
+        shop_url = frappe.get_request_header("X-Shopify-Shop-Domain")
+        verify_webhook(shop_url)
     data = frappe.parse_json(data)
-    create_sales_order(data)
-    customer_name = data.get("customer").get("first_name") + data.get("customer").get("last_name")
-    get_address(data, customer_name)
-    return "Order Created"
+    order_id = str(data.get("id"))
+    save_snapshots([data], shop_url)
+    record_received([order_id])
+    frappe.enqueue(
+        "divyam.api.process_order",
+        queue="short",
+        job_id=f"shopify_order::{order_id}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        order_id=order_id,
+    )
+    return "Order Received"
+
+def verify_webhook(shop_url):
+    # the endpoint is open to guests, so only a body signed with the store's
+    # webhook secret is accepted; unknown shops throw in get_store
+    store = get_store(shop_url)
+    secret = get_decrypted_password("Shopify Store", store.name, "webhook_secret", raise_exception=False)
+    signature = frappe.get_request_header("X-Shopify-Hmac-Sha256") or ""
+    if not secret or not hmac.compare_digest(sign_webhook(secret, frappe.request.get_data()), signature):
+        frappe.throw("Invalid Shopify webhook signature", frappe.AuthenticationError)
+
+def sign_webhook(secret, body):
+    # base64 HMAC-SHA256 of the raw body, as Shopify sends it in X-Shopify-Hmac-Sha256
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+def process_order(order_id):
+    if get_existing_order_ids([{"id": order_id}]):
+        mark_existing([order_id])
+        return
+    # the poller may have picked the order up already
+    if not claim_orders([order_id]):
+        return
+    try:
+        # an unknown shop fails the order like any other error
+        payload = frappe.db.get_value("Shopify Order Payload", order_id, ["payload", "shop_url"], as_dict=True)
+        create_sales_order(frappe.parse_json(payload.payload), get_store(payload.shop_url))
+    except Exception as e:
+        traceback = frappe.get_traceback()
+        frappe.db.rollback()
+        mark_failed([order_id], traceback, type(e).__name__)
+        frappe.db.commit()
+        raise
 
-def create_customer(customer_name):
-    customer = frappe.get_doc({
-        "doctype": "Customer",
+def get_customer_id(data):
+    customer_id = data.get("customer").get("id")
+    return customer_id and str(customer_id)
+
+def create_customer(data, customer_name):
+    return get_or_create("Customer", get_customer_id(data), {
         "customer_name": customer_name,
         "customer_type": "Individual",
         "customer_group": "Shopify",
         "territory": "All Territories",
-
-    })
-    customer.insert(ignore_permissions=True)
-    frappe.db.commit()
-    return customer
+    }, {"customer_name": customer_name})
 
 def get_address(data, customer):
-    if frappe.db.exists("Address", {'email_id': data.get('customer').get('email')}):
-        customer_address = frappe.get_doc("Address", {'email_id': data.get('customer').get('email')})
-
-    else:
-        customer_address = frappe.get_doc({
-            "doctype": "Address",
-            "address_title": customer,
-            "address_type": "Billing",
-            "address_line1": data.get('customer').get("default_address").get("address1"),
-            "address_line2": data.get('customer').get("default_address").get("address2"),
-            "city": data.get('customer').get("default_address").get("city"),
-            "state": data.get('customer').get("default_address").get("province"),
-            "pincode": data.get('customer').get("default_address").get("zip"),
-            "country": data.get('customer').get("default_address").get("country"),
-            "email_id": data.get('customer').get("email"),
-            "phone": data.get('customer').get("phone"),
-        })
-        #append the customer to address links
-        
-        customer_address.insert(ignore_permissions=True)
-        frappe.db.commit()
-    return customer_address.name
-         
-
-
-def get_tax(data):
-	tax = []
-	for item in data.get("line_items"):
-		tax.append({
-			"charge_type": "On Net Total",
-			"account_head": "Output Tax IGST - DPL",
-			"cost_center": "Main - DPL",
-			"tax_amount": data.get("total_tax"),
-            "description": "IGST - 5.00%"
-		})
-	return tax
-
-def get_item(data):
-    items = []
-    for item in data.get("line_items"):
-        item = {
-            "item_code": item.get("sku"),
-            "qty": item.get("quantity"),
-            "rate": item.get("price"),
-            "warehouse": "Finished Goods - DPL",
-            "delivery_date": getdate(data.get("created_at")),
-            "uom": "Meter",
-            "gst_treatment": "Taxable",
-            'igs_amount': get_igst(item)[0] if get_igst(item) else 0,
-            'igs_rate': get_igst(item)[1] if get_igst(item) else 0,
-            'sgst_amount': get_sgst(item)[0] if get_sgst(item) else 0,
-            'sgst_rate': get_sgst(item)[1] if get_sgst(item) else 0,
-            'cgst_amount': get_cgst(item)[0] if get_cgst(item) else 0,
-            'cgst_rate': get_cgst(item)[1] if get_cgst(item) else 0,
-            
-
-
-        }
-        items.append(item)
-    return items
-
-def create_sales_order(data):
+    default_address = data.get('customer').get("default_address")
+    return get_or_create("Address", get_customer_id(data), {
+        "address_title": customer,
+        "address_type": "Billing",
+        "address_line1": default_address.get("address1"),
+        "address_line2": default_address.get("address2"),
+        "city": default_address.get("city"),
+        "state": default_address.get("province"),
+        "pincode": default_address.get("zip"),
+        "country": default_address.get("country"),
+        "email_id": data.get('customer').get("email"),
+        "phone": data.get('customer').get("phone"),
+    }, {'email_id': data.get('customer').get('email')})
+
+
+def create_sales_order(data, store=None):
     customer_name = data.get("customer").get("first_name") + " " + data.get("customer").get("last_name")
-    if frappe.db.exists("Customer", {"customer_name": customer_name}):
-        customer = frappe.get_doc("Customer", {"customer_name": customer_name})
-    else:
-        customer = create_customer(customer_name)
-
-    items = get_item(data)
-    taxes = get_tax(data)
-    sales_order = frappe.get_doc({
-        "doctype": "Sales Order",
-        "shopify_order_id": data.get("id"),
-        "shopify_order_number": data.get("name"),
-        "customer": customer.name,
-        "items": items,
-        "delivery_date": getdate(data.get("created_at")),
-        "order_type": "Sales",
-        "company": "Doeraa Private Limited",
-        "currency": data.get("currency"),
-        "taxes_and_charges": "Output GST Out-state - DPL",
-        "tax_category": "Ecommerce Integrations - Ignore",
-        "taxes": taxes,
-        "customer_address": get_address(data, customer_name),
-		
-    })
-
+    customer = create_customer(data, customer_name)
+    address = get_address(data, customer_name)
+    create_missing_items([data])
+    store, exchange_rates = get_currency_settings(store, [data], getdate())
+    sales_order = frappe.get_doc(build_sales_order(data, customer, address, getdate(), store, exchange_rates))
     sales_order.insert(ignore_permissions=True)
+    mark_created(data.get("id"), sales_order.name)
     frappe.db.commit()
     return sales_order.name
 
-def get_igst(item):
-    tax_lines = item.get("tax_lines")
-    for tax_line in tax_lines:
-        if tax_line.get("title") == "IGST":
-            return float(tax_line.get("price")), float(tax_line.get("rate"))
-
-def get_cgst(item):
-    tax_lines = item.get("tax_lines")
-    for tax_line in tax_lines:
-        if tax_line.get("title") == "CGST":
-            return float(tax_line.get("price")), float(tax_line.get("rate"))
-
-def get_sgst(item):
-	tax_lines = item.get("tax_lines")
-	for tax_line in tax_lines:
-		if tax_line.get("title") == "SGST":
-			return float(tax_line.get("price")), float(tax_line.get("rate"))
-
 
 @frappe.whitelist(allow_guest=True)
 def delete_sales_orders():
@@ -0,0 +1,214 @@
+#re-import historical Shopify orders in date windows on several background workers
+# A Shopify Backfill splits its date range into windows, one job per window on
+# the long queue. At most max_parallel_jobs windows are queued or running at a
+# time; every finished window queues the next pending one. A window only
+# commits its own orders, so a failed window can be retried on its own.
+#
+# In Bulk Operation mode Shopify exports the whole range as one JSONL file,
+# which is streamed into the same pipeline; a shop can only run one bulk
+# operation at a time, so that mode uses a single window.
+#
+#   bench --site site1 execute divyam.backfill.start_backfill --kwargs "{'from_date': '2023-04-01', 'to_date': '2024-03-31'}"
+from datetime import datetime, time
+from zoneinfo import ZoneInfo
+
+import frappe
+from frappe.utils import add_days, add_to_date, cint, flt, get_datetime, getdate, now_datetime
+
+from divyam.shopify import OrderPages, create_sales_order, get_client, get_store, save_snapshots
+from divyam.shopify_bulk import export_orders, iter_batches, iter_lines, read_orders
+from divyam.sync_run import sync_run
+
+DEFAULT_WINDOW_DAYS = 30
+DEFAULT_MAX_PARALLEL_JOBS = 4
+# windows are whole days in the shop's time zone
+DEFAULT_TIME_ZONE = "Asia/Kolkata"
+WINDOW_TIMEOUT = 6 * 60 * 60
+# a Queued or Running window untouched for longer lost its job to the timeout
+# or a worker restart and is queued again
+STALE_WINDOW_SECONDS = WINDOW_TIMEOUT + 30 * 60
+
+
+@frappe.whitelist()
+def start_backfill(from_date, to_date, window_days=None, max_parallel_jobs=None, mode="REST", shop_url=None):
+    backfill = frappe.get_doc({
+        "doctype": "Shopify Backfill",
+        "from_date": from_date,
+        "to_date": to_date,
+        "shop_url": shop_url,
+        "mode": mode,
+        "window_days": cint(window_days) or DEFAULT_WINDOW_DAYS,
+        "max_parallel_jobs": cint(max_parallel_jobs) or DEFAULT_MAX_PARALLEL_JOBS,
+    })
+    # inserting builds the windows and queues the first ones
+    backfill.insert()
+    return backfill.name
+
+
+def make_windows(from_date, to_date, window_days=None, mode="REST"):
+    # [(start, end)] covering from_date..to_date, both ends inclusive
+    window_days = cint(window_days) or DEFAULT_WINDOW_DAYS
+    start, to_date = getdate(from_date), getdate(to_date)
+    if mode == "Bulk Operation":
+        return [(start, to_date)]
+    windows = []
+    while start <= to_date:
+        end = min(add_days(start, window_days - 1), to_date)
+        windows.append((start, end))
+        start = add_days(end, 1)
+    return windows
+
+
+def enqueue_windows(backfill):
+    # Called after insert and whenever a window finishes. The parent row is
+    # locked so two windows finishing together do not both queue the same one.
+    max_jobs = cint(frappe.db.get_value("Shopify Backfill", backfill, "max_parallel_jobs", for_update=True))
+    windows = get_windows(backfill)
+    for window in windows:
+        if is_stale(window):
+            frappe.db.set_value("Shopify Backfill Window", window.name, {"status": "Pending", "error": None})
+            window.status = "Pending"
+    active = sum(1 for window in windows if window.status in ("Queued", "Running"))
+    for window in windows:
+        if active >= (max_jobs or DEFAULT_MAX_PARALLEL_JOBS):
+            break
+        if window.status != "Pending":
+            continue
+        frappe.db.set_value("Shopify Backfill Window", window.name, "status", "Queued")
+        frappe.enqueue(
+            "divyam.backfill.run_window",
+            queue="long",
+            timeout=WINDOW_TIMEOUT,
+            job_id=f"shopify_backfill::{window.name}",
+            deduplicate=True,
+            enqueue_after_commit=True,
+            backfill=backfill,
+            window=window.name,
+        )
+        active += 1
+    return update_progress(backfill)
+
+
+def run_window(backfill, window):
+    row = frappe.db.get_value("Shopify Backfill Window", window, ["window_start", "window_end", "status"], as_dict=True)
+    if not row or row.status != "Queued":
+        return
+    frappe.db.set_value("Shopify Backfill Window", window, {"status": "Running", "error": None})
+    frappe.db.commit()
+
+    mode, shop_url = frappe.db.get_value("Shopify Backfill", backfill, ["mode", "shop_url"])
+    import_orders = import_window_bulk if mode == "Bulk Operation" else import_window
+    values = {}
+    try:
+        with sync_run(f"divyam.backfill.run_window {shop_url} {row.window_start}..{row.window_end}") as stats:
+            values["sync_run"] = stats.run
+            import_orders(row.window_start, row.window_end, stats, get_store(shop_url))
+        values.update(status="Completed", orders_created=stats.orders_created, orders_failed=stats.orders_failed)
+    except Exception:
+        # sync_run has rolled back and recorded the traceback on the run
+        values.update(status="Failed", error=frappe.get_traceback())
+
+    frappe.db.set_value("Shopify Backfill Window", window, values)
+    enqueue_windows(backfill)
+    frappe.db.commit()
+
+
+def get_window_bounds(window_start, window_end, time_zone=None):
+    # first and last second of the window in the shop's time zone, with the
+    # offset of that date, so daylight saving is respected
+    zone = ZoneInfo(time_zone or DEFAULT_TIME_ZONE)
+    return (
+        datetime.combine(getdate(window_start), time(0, 0, 0), zone).isoformat(),
+        datetime.combine(getdate(window_end), time(23, 59, 59), zone).isoformat(),
+    )
+
+
+def import_window(window_start, window_end, stats, store=None):
+    store = get_store(store)
+    created_at_min, created_at_max = get_window_bounds(window_start, window_end, store.time_zone)
+    params = {
+        "created_at_min": created_at_min,
+        "created_at_max": created_at_max,
+        "status": "any",
+        "order": "created_at asc",
+        "limit": 250,
+    }
+    failed = set()
+    customer_cache = {}
+    pages = OrderPages("orders.json", params, stats, store)
+    for orders, _next_url in pages:
+        create_sales_order(orders, failed, customer_cache, stats, store)
+    if pages.error:
+        raise pages.error
+
+
+def import_window_bulk(window_start, window_end, stats, store=None):
+    store = get_store(store)
+    created_at_min, created_at_max = get_window_bounds(window_start, window_end, store.time_zone)
+    search = f"created_at:>='{created_at_min}' AND created_at:<='{created_at_max}'"
+    with stats.timer("http"):
+        url = export_orders(get_client(store), search, timeout=WINDOW_TIMEOUT)
+    if not url:
+        return
+    failed = set()
+    customer_cache = {}
+    for orders in iter_batches(read_orders(iter_lines(url))):
+        stats.pages += 1
+        save_snapshots(orders, store.shop_url)
+        create_sales_order(orders, failed, customer_cache, stats, store)
+
+
+@frappe.whitelist()
+def retry_failed_windows(backfill):
+    # windows that failed, or created some orders but not all, run again;
+    # orders that already exist are skipped
+    frappe.get_doc("Shopify Backfill", backfill).check_permission("write")
+    for window in get_windows(backfill):
+        if window.status == "Failed" or (window.status == "Completed" and window.orders_failed) or is_stale(window):
+            frappe.db.set_value("Shopify Backfill Window", window.name, {"status": "Pending", "error": None})
+    return enqueue_windows(backfill)
+
+
+@frappe.whitelist()
+def get_backfill_progress(backfill):
+    frappe.get_doc("Shopify Backfill", backfill).check_permission("read")
+    return update_progress(backfill)
+
+
+def update_progress(backfill):
+    windows = get_windows(backfill)
+    counts = {}
+    for window in windows:
+        counts[window.status] = counts.get(window.status, 0) + 1
+    done = counts.get("Completed", 0) + counts.get("Failed", 0)
+    if done == len(windows):
+        status = "Failed" if counts.get("Failed") else "Completed"
+    elif counts.get("Running") or done:
+        status = "Running"
+    else:
+        status = "Queued"
+
+    progress = {
+        "status": status,
+        "progress": flt(100 * done / len(windows), 2) if windows else 100,
+        "orders_created": sum(cint(window.orders_created) for window in windows),
+        "orders_failed": sum(cint(window.orders_failed) for window in windows),
+    }
+    frappe.db.set_value("Shopify Backfill", backfill, progress, update_modified=False)
+    progress["windows"] = counts
+    return progress
+
+
+def is_stale(window):
+    return window.status in ("Queued", "Running") and get_datetime(window.modified) < add_to_date(
+        now_datetime(), seconds=-STALE_WINDOW_SECONDS
+    )
+
+
+def get_windows(backfill):
+    return frappe.get_all(
+        "Shopify Backfill Window",
+        filters={"parent": backfill, "parenttype": "Shopify Backfill"},
+        fields=["name", "status", "orders_created", "orders_failed", "modified"],
+        order_by="idx",
+    )
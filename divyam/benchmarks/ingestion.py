@@ -0,0 +1,114 @@
+#end-to-end benchmark of the Shopify ingestion against a local stand-in shop
+# Runs the scheduled sync and the order webhook on a test site and reports
+# throughput, database queries per order and peak memory:
+#
+#   bench --site test_site execute divyam.benchmarks.ingestion.run --kwargs "{'orders': 2000}"
+#
+# Sales Orders, customers and payload snapshots created by the run are left on
+# the site; never point this at production.
+import json
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import frappe
+
+from divyam import api, shopify
+from divyam.benchmarks.orders import make_orders
+from divyam.benchmarks.stand_in import ShopifyStandIn
+from divyam.shopify_client import ShopifyClient
+
+# watermark fields of the Shopify Store that the poller scenario overwrites
+SYNC_STATE_FIELDS = ("last_order_updated_at", "last_order_id", "sync_checkpoint")
+
+
+def run(orders=1000, lines=3, latency=0.05, webhook_orders=None):
+    if not frappe.conf.allow_tests and not frappe.flags.in_test:
+        frappe.throw("Enable allow_tests in the site config to run the ingestion benchmark")
+
+    # fresh order ids every run, otherwise everything after the first run is skipped as existing
+    start = int(time.time()) * 1000
+    polled = make_orders(orders, start=start, lines=lines)
+    pushed = make_orders(orders if webhook_orders is None else webhook_orders, start=start + orders, lines=lines)
+
+    results = {}
+    with ShopifyStandIn(polled, latency=latency) as shop:
+        with sync_state(), stand_in_client(shop.url):
+            with measure(len(polled)) as result:
+                shopify.get_shopify_data()
+            result["requests"] = shop.requests
+            result["throttled"] = shop.throttled
+            results["get_shopify_data"] = result
+
+    with measure(len(pushed)) as result:
+        for order in pushed:
+            # the webhook stores and queues the order, the queued job creates it
+            api.create_order(json.dumps(order))
+            api.process_order(str(order["id"]))
+    results["create_order"] = result
+
+    print(json.dumps(results, indent=1))
+    return results
+
+
+@contextmanager
+def measure(count):
+    result = {"orders": count}
+    queries = count_queries()
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        elapsed = time.perf_counter() - started
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        frappe.db.sql = queries.sql
+    result.update({
+        "seconds": round(elapsed, 3),
+        "orders_per_second": round(count / elapsed, 2) if elapsed else 0,
+        "queries": queries.count,
+        "queries_per_order": round(queries.count / count, 2) if count else 0,
+        "peak_python_memory_mb": round(peak / 1024 / 1024, 1),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+
+
+def count_queries():
+    # every helper of frappe.db ends up in frappe.db.sql, so wrapping it on the
+    # connection counts all queries of the measured block
+    counter = frappe._dict(count=0, sql=frappe.db.sql)
+
+    def sql(*args, **kwargs):
+        counter.count += 1
+        return counter.sql(*args, **kwargs)
+
+    frappe.db.sql = sql
+    return counter
+
+
+@contextmanager
+def stand_in_client(url):
+    original = shopify.get_client
+    client = ShopifyClient(url, "benchmark")
+    shopify.get_client = lambda store=None: client
+    try:
+        yield
+    finally:
+        shopify.get_client = original
+
+
+@contextmanager
+def sync_state():
+    # start the poller of the first store from scratch and put its real
+    # watermark back afterwards
+    store = shopify.get_store()
+    frappe.db.set_value("Shopify Store", store.name, {field: None for field in SYNC_STATE_FIELDS})
+    frappe.db.commit()
+    try:
+        yield
+    finally:
+        frappe.db.set_value("Shopify Store", store.name, {field: store[field] for field in SYNC_STATE_FIELDS})
+        frappe.db.commit()
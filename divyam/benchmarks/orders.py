@@ -0,0 +1,133 @@
+#synthetic Shopify order payloads for tests and benchmarks
+import random
+
+STATES = ["Gujarat", "Maharashtra", "Karnataka", "Tamil Nadu", "Delhi", "West Bengal"]
+
+
+def make_order(order_id, lines=3, seed=None):
+    # shaped like a REST orders.json entry, including the fields the sync never
+    # reads, so payload sizes are realistic
+    rng = random.Random(order_id if seed is None else seed)
+    state = rng.choice(STATES)
+    created_at = f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:15:00+05:30"
+    customer_id = 7000000000000 + rng.randint(1, 5000)
+    address = {
+        "first_name": "Test",
+        "last_name": f"Customer {customer_id}",
+        "address1": f"{rng.randint(1, 999)} Ring Road",
+        "address2": "",
+        "city": "Surat",
+        "province": state,
+        "country": "India",
+        "zip": f"{rng.randint(110000, 799999)}",
+        "phone": "+919999999999",
+    }
+    line_items = []
+    for line in range(lines):
+        price = rng.choice([450, 650, 890, 1250, 2100])
+        quantity = rng.randint(1, 6)
+        taxable = price * quantity
+        if state == "Gujarat":
+            tax_lines = [
+                {"title": "CGST", "price": f"{taxable * 0.025:.2f}", "rate": 0.025},
+                {"title": "SGST", "price": f"{taxable * 0.025:.2f}", "rate": 0.025},
+            ]
+        else:
+            tax_lines = [{"title": "IGST", "price": f"{taxable * 0.05:.2f}", "rate": 0.05}]
+        line_items.append({
+            "id": order_id * 10 + line,
+            "sku": f"FAB-{rng.randint(1, 800):04d}",
+            "name": f"Printed Cotton Fabric {line}",
+            "price": f"{price:.2f}",
+            "quantity": quantity,
+            "tax_lines": tax_lines,
+            "properties": [],
+            "discount_allocations": [],
+        })
+    return {
+        "id": order_id,
+        "name": f"#{order_id}",
+        "created_at": created_at,
+        "updated_at": created_at,
+        "currency": "INR",
+        "taxes_included": True,
+        "total_tax": "0.00",
+        "customer": {
+            "id": customer_id,
+            "email": f"customer{customer_id}@example.com",
+            "first_name": address["first_name"],
+            "last_name": address["last_name"],
+            "phone": address["phone"],
+            "default_address": address,
+        },
+        "billing_address": address,
+        "shipping_address": address,
+        "line_items": line_items,
+        "shipping_lines": [{"title": "Standard", "price": rng.choice(["0.00", "99.00"])}],
+        "discount_codes": [{"code": "SALE", "amount": "100.00"}] if rng.random() < 0.3 else [],
+        "note_attributes": [],
+        "client_details": {"browser_ip": "127.0.0.1", "user_agent": "Mozilla/5.0"},
+        "fulfillments": [],
+        "refunds": [],
+    }
+
+
+def make_orders(count, start=1000000, lines=3):
+    return [make_order(start + i, lines=lines) for i in range(count)]
+
+
+def to_bulk_lines(order):
+    # the JSONL lines a GraphQL bulk export produces for a make_order payload:
+    # the order itself, then one line per line item pointing back to it
+    order_gid = f"gid://shopify/Order/{order['id']}"
+    customer = order["customer"]
+    discount = order["discount_codes"][0]["amount"] if order["discount_codes"] else "0.00"
+    lines = [{
+        "id": order_gid,
+        "name": order["name"],
+        "createdAt": order["created_at"],
+        "updatedAt": order["updated_at"],
+        "currencyCode": order["currency"],
+        "taxesIncluded": order["taxes_included"],
+        "discountCodes": [code["code"] for code in order["discount_codes"]],
+        "totalDiscountsSet": {"shopMoney": {"amount": discount}},
+        "shippingLine": {"originalPriceSet": {"shopMoney": {"amount": order["shipping_lines"][0]["price"]}}},
+        "customer": {
+            "id": f"gid://shopify/Customer/{customer['id']}",
+            "email": customer["email"],
+            "firstName": customer["first_name"],
+            "lastName": customer["last_name"],
+            "phone": customer["phone"],
+            "defaultAddress": to_graphql_address(customer["default_address"]),
+        },
+        "billingAddress": to_graphql_address(order["billing_address"]),
+        "shippingAddress": to_graphql_address(order["shipping_address"]),
+    }]
+    for item in order["line_items"]:
+        lines.append({
+            "id": f"gid://shopify/LineItem/{item['id']}",
+            "sku": item["sku"],
+            "name": item["name"],
+            "quantity": item["quantity"],
+            "originalUnitPriceSet": {"shopMoney": {"amount": item["price"]}},
+            "taxLines": [
+                {"title": tax["title"], "rate": tax["rate"], "priceSet": {"shopMoney": {"amount": tax["price"]}}}
+                for tax in item["tax_lines"]
+            ],
+            "__parentId": order_gid,
+        })
+    return lines
+
+
+def to_graphql_address(address):
+    return {
+        "firstName": address["first_name"],
+        "lastName": address["last_name"],
+        "address1": address["address1"],
+        "address2": address["address2"],
+        "city": address["city"],
+        "province": address["province"],
+        "country": address["country"],
+        "zip": address["zip"],
+        "phone": address["phone"],
+    }
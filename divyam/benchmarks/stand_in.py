@@ -0,0 +1,222 @@
+#local imitation of the Shopify orders api for tests and benchmarks
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from divyam.benchmarks.orders import to_bulk_lines
+from divyam.shopify_client import API_VERSION
+
+BULK_OPERATION_ID = "gid://shopify/BulkOperation/1"
+FILTERS = ("updated_at_min", "created_at_min", "created_at_max", "ids", "name")
+
+
+class ShopifyStandIn:
+    # Serves orders.json the way Shopify does: cursor pagination through Link
+    # headers, the updated_at / created_at / ids / name / fields filters, the
+    # call limit header and 429s once the request bucket overflows. latency is
+    # added to every response.
+    #
+    # graphql.json answers the two calls of a bulk export: the first
+    # currentBulkOperation polls report RUNNING, then the export completes with
+    # a url for bulk_file, a canned JSONL file, or a file generated from orders.
+    #
+    #   with ShopifyStandIn(make_orders(1000), latency=0.05) as shop:
+    #       client = ShopifyClient(shop.url, "token")
+    def __init__(self, orders, latency=0.0, bucket_size=40, leak_rate=2.0, bulk_file=None, bulk_polls=1):
+        self.orders = sorted(orders, key=lambda order: (order.get("updated_at") or "", order["id"]))
+        self.bulk_file = bulk_file
+        self.bulk_polls = bulk_polls
+        self.bulk_status = None
+        self.bulk_polls_left = 0
+        self.latency = latency
+        self.bucket_size = bucket_size
+        self.leak_rate = leak_rate
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.shop = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def take_call(self):
+        # returns the bucket level after this call, or None when it overflowed
+        with self.lock:
+            now = time.monotonic()
+            self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+            self.updated = now
+            self.requests += 1
+            if self.level + 1 > self.bucket_size:
+                self.throttled += 1
+                return None
+            self.level += 1
+            return int(self.level)
+
+    def list_orders(self, query):
+        if "page_info" in query:
+            # like Shopify, a cursor carries the filters of the first request
+            # and only limit and fields may be given next to it
+            cursor = decode_cursor(query["page_info"])
+            filters, offset = cursor["filters"], cursor["offset"]
+        else:
+            filters = {key: query[key] for key in FILTERS if key in query}
+            offset = 0
+        limit = min(int(query.get("limit") or 50), 250)
+
+        orders = self.orders
+        if filters.get("updated_at_min"):
+            orders = [o for o in orders if parse_time(o.get("updated_at")) >= parse_time(filters["updated_at_min"])]
+        if filters.get("created_at_min"):
+            orders = [o for o in orders if parse_time(o.get("created_at")) >= parse_time(filters["created_at_min"])]
+        if filters.get("created_at_max"):
+            orders = [o for o in orders if parse_time(o.get("created_at")) <= parse_time(filters["created_at_max"])]
+        if filters.get("ids"):
+            ids = set(filters["ids"].split(","))
+            orders = [o for o in orders if str(o["id"]) in ids]
+        if filters.get("name"):
+            orders = [o for o in orders if o.get("name") == filters["name"]]
+
+        page = orders[offset:offset + limit]
+        if query.get("fields"):
+            fields = query["fields"].split(",")
+            page = [{field: order[field] for field in fields if field in order} for order in page]
+
+        next_query = None
+        if offset + limit < len(orders):
+            next_query = {"limit": limit, "page_info": encode_cursor(filters, offset + limit)}
+            if query.get("fields"):
+                next_query["fields"] = query["fields"]
+        return page, next_query
+
+
+    def bulk_lines(self):
+        if self.bulk_file:
+            with open(self.bulk_file, "rb") as f:
+                yield from f
+            return
+        for order in sorted(self.orders, key=lambda order: order["created_at"]):
+            for line in to_bulk_lines(order):
+                yield json.dumps(line).encode() + b"\n"
+
+    def graphql(self, query):
+        if "bulkOperationRunQuery" in query:
+            if self.bulk_status == "RUNNING":
+                return {"bulkOperationRunQuery": {"bulkOperation": None, "userErrors": [
+                    {"field": None, "message": "A bulk query operation for this app and shop is already in progress"}
+                ]}}
+            self.bulk_status, self.bulk_polls_left = "RUNNING", self.bulk_polls
+            return {"bulkOperationRunQuery": {
+                "bulkOperation": {"id": BULK_OPERATION_ID, "status": "CREATED"},
+                "userErrors": [],
+            }}
+        if "currentBulkOperation" in query:
+            if self.bulk_status == "RUNNING":
+                if self.bulk_polls_left:
+                    self.bulk_polls_left -= 1
+                else:
+                    self.bulk_status = "COMPLETED"
+            return {"currentBulkOperation": self.bulk_status and {
+                "id": BULK_OPERATION_ID,
+                "status": self.bulk_status,
+                "errorCode": None,
+                "objectCount": str(len(self.orders)),
+                "url": f"{self.url}/bulk/orders.jsonl" if self.bulk_status == "COMPLETED" else None,
+            }}
+        return None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        shop = self.server.shop
+        if shop.latency:
+            time.sleep(shop.latency)
+        if urlsplit(self.path).path != f"/admin/api/{API_VERSION}/graphql.json":
+            return self.reply(404, {"errors": "Not Found"})
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        data = shop.graphql(body.get("query") or "")
+        if data is None:
+            return self.reply(200, {"errors": [{"message": "The stand-in only knows bulk operation queries"}]})
+        self.reply(200, {"data": data})
+
+    def do_GET(self):
+        shop = self.server.shop
+        if shop.latency:
+            time.sleep(shop.latency)
+
+        url = urlsplit(self.path)
+        if url.path == "/bulk/orders.jsonl":
+            return self.stream(shop.bulk_lines())
+        if url.path != f"/admin/api/{API_VERSION}/orders.json":
+            return self.reply(404, {"errors": "Not Found"})
+        level = shop.take_call()
+        if level is None:
+            return self.reply(429, {"errors": "Exceeded 2 calls per second for api client."}, {"Retry-After": "1.0"})
+
+        orders, next_query = shop.list_orders(dict(parse_qsl(url.query)))
+        headers = {"X-Shopify-Shop-Api-Call-Limit": f"{level}/{shop.bucket_size}"}
+        if next_query:
+            headers["Link"] = f'<{shop.url}{url.path}?{urlencode(next_query)}>; rel="next"'
+        self.reply(200, {"orders": orders}, headers)
+
+    def reply(self, status, body, headers=None):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, lines):
+        # chunked, so large files are never built in memory
+        self.send_response(200)
+        self.send_header("Content-Type", "application/jsonl")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for line in lines:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+def encode_cursor(filters, offset):
+    payload = json.dumps({"filters": filters, "offset": offset}).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(page_info):
+    return json.loads(base64.urlsafe_b64decode(page_info.encode()))
+
+
+def parse_time(value):
+    # Shopify accepts both 2024-05-01T10:20:30Z and offsets like +05:30
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
@@ -0,0 +1,32 @@
+#micro-benchmark for divyam.shopify_transform
+# python -m divyam.benchmarks.transform [orders] [lines per order]
+import sys
+import time
+from datetime import date
+
+from divyam.benchmarks.orders import make_orders
+from divyam.shopify_transform import build_sales_order, get_store_settings
+
+
+def run(count=10000, lines=3, repeat=5):
+    orders = make_orders(count, lines=lines)
+    today = date.today()
+    # create_sales_order resolves the store settings once per batch and builds each order on its own
+    store = get_store_settings()
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        built = sum(1 for order in orders if build_sales_order(order, "Customer", "Address", today, store))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "orders": built,
+        "lines_per_order": lines,
+        "seconds": round(best, 4),
+        "orders_per_second": round(built / best),
+    }
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    print(run(*args))
@@ -1,8 +1,15 @@
 // Copyright (c) 2024, erpera and contributors
 // For license information, please see license.txt
 
-// frappe.ui.form.on("Divyam Settings", {
-// 	refresh(frm) {
-
-// 	},
-// });
+frappe.ui.form.on("Divyam Settings", {
+	refresh(frm) {
+		frm.add_custom_button(__("Sync Status"), () => {
+			frappe.call("divyam.shopify.get_sync_status").then(({ message }) => {
+				frappe.msgprint({
+					title: __("Shopify Sync Status"),
+					message: `<pre>${frappe.utils.escape_html(JSON.stringify(message, null, 2))}</pre>`,
+				});
+			});
+		});
+	},
+});
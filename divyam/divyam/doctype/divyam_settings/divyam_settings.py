@@ -4,6 +4,13 @@
 # import frappe
 from frappe.model.document import Document
 
+from divyam.shopify import clear_client_cache
+
 
 class DivyamSettings(Document):
-	pass
+	def validate(self):
+		for store in self.stores:
+			store.validate_store()
+
+	def on_update(self):
+		clear_client_cache()
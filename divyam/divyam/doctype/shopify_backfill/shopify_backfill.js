@@ -0,0 +1,16 @@
+// Copyright (c) 2026, erpera and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("Shopify Backfill", {
+	refresh(frm) {
+		if (frm.doc.status === "Failed" || frm.doc.orders_failed) {
+			frm.add_custom_button(__("Retry Failed Windows"), () => {
+				frappe.call({
+					method: "divyam.backfill.retry_failed_windows",
+					args: { backfill: frm.doc.name },
+					callback: () => frm.reload_doc(),
+				});
+			});
+		}
+	},
+});
@@ -0,0 +1,26 @@
+# Copyright (c) 2026, erpera and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import getdate
+
+from divyam.backfill import enqueue_windows, make_windows
+from divyam.shopify import get_store
+
+
+class ShopifyBackfill(Document):
+	def validate(self):
+		if getdate(self.from_date) > getdate(self.to_date):
+			frappe.throw(_("From Date cannot be after To Date"))
+		if self.is_new():
+			# throws for a shop that is not set up
+			self.shop_url = get_store(self.shop_url).shop_url
+			self.set("windows", [
+				{"window_start": start, "window_end": end}
+				for start, end in make_windows(self.from_date, self.to_date, self.window_days, self.mode)
+			])
+
+	def after_insert(self):
+		enqueue_windows(self.name)
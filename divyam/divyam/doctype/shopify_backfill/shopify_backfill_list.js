@@ -0,0 +1,6 @@
+frappe.listview_settings["Shopify Backfill"] = {
+	get_indicator(doc) {
+		const colors = { Queued: "gray", Running: "blue", Completed: "green", Failed: "red" };
+		return [__(doc.status), colors[doc.status], "status,=," + doc.status];
+	},
+};
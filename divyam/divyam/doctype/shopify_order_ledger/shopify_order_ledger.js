@@ -0,0 +1,16 @@
+// Copyright (c) 2026, erpera and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("Shopify Order Ledger", {
+	refresh(frm) {
+		if (frm.doc.state === "Failed") {
+			frm.add_custom_button(__("Retry Now"), () => {
+				frappe.call({
+					method: "divyam.order_ledger.retry_now",
+					args: { order_id: frm.doc.name },
+					callback: () => frm.reload_doc(),
+				});
+			});
+		}
+	},
+});
@@ -0,0 +1,6 @@
+frappe.listview_settings["Shopify Order Ledger"] = {
+	get_indicator(doc) {
+		const colors = { Received: "gray", Processing: "blue", Created: "green", Failed: "red" };
+		return [__(doc.state), colors[doc.state], "state,=," + doc.state];
+	},
+};
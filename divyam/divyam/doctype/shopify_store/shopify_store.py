@@ -0,0 +1,20 @@
+# Copyright (c) 2026, erpera and contributors
+# For license information, please see license.txt
+
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import frappe
+from frappe.model.document import Document
+
+from divyam.shopify import normalize_shop_url
+
+
+class ShopifyStore(Document):
+	def validate_store(self):
+		# child rows are not validated on their own; Divyam Settings calls this
+		self.shop_url = normalize_shop_url(self.shop_url)
+		if self.time_zone:
+			try:
+				ZoneInfo(self.time_zone)
+			except (ZoneInfoNotFoundError, ValueError):
+				frappe.throw(f"Row {self.idx}: {self.time_zone} is not a time zone, e.g. Asia/Kolkata")
@@ -0,0 +1,6 @@
+frappe.listview_settings["Shopify Sync Run"] = {
+	get_indicator(doc) {
+		const colors = { Running: "blue", Completed: "green", Failed: "red" };
+		return [__(doc.status), colors[doc.status], "status,=," + doc.status];
+	},
+};
@@ -153,11 +153,14 @@ scheduler_events = {
 # 	"monthly": [
 # 		"divyam.tasks.monthly"
 # 	],  
-#set cron job for every 5 minutes
+#check every minute; the sync decides how often it actually runs
     "cron": {
-        "*/5 * * * *": [
-            "divyam.shopify.get_shopify_data",
-        ]
+        "* * * * *": [
+            "divyam.shopify.poll_shopify",
+        ],
+        "*/10 * * * *": [
+            "divyam.shopify.retry_failed_orders",
+        ],
     }
 }
 
@@ -233,9 +236,10 @@ scheduler_events = {
 # Automatically update python controller files with type annotations for this app.
 # export_python_type_annotations = True
 
-# default_log_clearing_doctypes = {
-# 	"Logging DocType Name": 30  # days to retain logs
-# }
+default_log_clearing_doctypes = {
+	# one run per store every few minutes plus the retry job adds up quickly
+	"Shopify Sync Run": 30,
+}
 
 fixtures = [
     {"doctype": "Client Script", 
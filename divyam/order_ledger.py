@@ -0,0 +1,140 @@
+#one Shopify Order Ledger row per Shopify order, shared by the webhook and the poller
+# An order is only created by the caller that claimed it. Claims are single
+# statements on the ledger's primary key, so when the webhook and the poller
+# see the same order at the same time exactly one of them gets it. Failed rows
+# double as the dead letter queue: they keep the error and are retried with
+# exponential backoff from their stored payload.
+import frappe
+from frappe.utils import add_to_date, cint, now
+
+# a Processing claim older than this belongs to a worker that died and may be taken over
+CLAIM_TIMEOUT_MINUTES = 30
+# retries wait 5, 10, 20, ... minutes, at most a day, and stop after MAX_ATTEMPTS
+RETRY_BASE_MINUTES = 5
+RETRY_MAX_MINUTES = 24 * 60
+MAX_ATTEMPTS = 10
+
+
+def record_received(order_ids):
+    # the webhook stores the order before queueing it; existing rows are left alone
+    insert_rows(order_ids, "Received")
+
+
+def claim_orders(order_ids):
+    # Returns the ids the caller may go on to create. Unknown orders are claimed
+    # by inserting their row, received, stale and failed orders whose backoff
+    # has run out by flipping the state; the claim token tells which rows this
+    # call won. A failed order seen again by the poller or a backfill therefore
+    # waits for its retry like any other.
+    order_ids = list({str(order_id) for order_id in order_ids})
+    if not order_ids:
+        return set()
+    token = frappe.generate_hash(length=16)
+    insert_rows(order_ids, "Processing", token)
+    frappe.db.sql("""
+        UPDATE `tabShopify Order Ledger`
+        SET state = 'Processing', claim_token = %(token)s, error = NULL, modified = %(now)s
+        WHERE name IN %(order_ids)s
+        AND (
+            state = 'Received'
+            OR (state = 'Failed' AND next_retry_at <= %(now)s)
+            OR (state = 'Processing' AND modified < %(stale)s)
+        )
+    """, {
+        "token": token,
+        "now": now(),
+        "order_ids": order_ids,
+        "stale": add_to_date(now(), minutes=-CLAIM_TIMEOUT_MINUTES),
+    })
+    claimed = set(frappe.get_all(
+        "Shopify Order Ledger",
+        filters={"name": ["in", order_ids], "claim_token": token, "state": "Processing"},
+        pluck="name",
+    ))
+    # commit right away so the other side sees the claim instead of waiting on the row lock
+    frappe.db.commit()
+    return claimed
+
+
+def mark_created(order_id, sales_order):
+    # not committed here: it goes in with the Sales Order insert
+    frappe.db.set_value("Shopify Order Ledger", str(order_id), {
+        "state": "Created",
+        "sales_order": sales_order,
+        "error": None,
+    })
+
+
+def mark_existing(order_ids):
+    # Received or failed orders whose Sales Order exists by now, e.g. created by
+    # hand, are settled instead of staying pending or coming up for retry
+    order_ids = [str(order_id) for order_id in order_ids]
+    if not order_ids:
+        return
+    frappe.db.sql("""
+        UPDATE `tabShopify Order Ledger` ledger
+        SET state = 'Created', error = NULL, next_retry_at = NULL, modified = %(now)s,
+            sales_order = (SELECT so.name FROM `tabSales Order` so WHERE so.shopify_order_id = ledger.name LIMIT 1)
+        WHERE ledger.name IN %(order_ids)s AND ledger.state IN ('Received', 'Failed')
+    """, {"now": now(), "order_ids": order_ids})
+
+
+def mark_failed(order_ids, error=None, error_class=None, retry=True):
+    # without retry the order is given up on at once, for payloads that can
+    # never succeed; retry_now still brings it back
+    for order_id in order_ids:
+        attempts = cint(frappe.db.get_value("Shopify Order Ledger", str(order_id), "attempts")) + 1
+        if not retry:
+            attempts = max(attempts, MAX_ATTEMPTS)
+        frappe.db.set_value("Shopify Order Ledger", str(order_id), {
+            "state": "Failed",
+            "error": error,
+            "error_class": error_class,
+            "attempts": attempts,
+            "next_retry_at": get_next_retry(attempts),
+        })
+
+
+def get_next_retry(attempts):
+    if attempts >= MAX_ATTEMPTS:
+        return None
+    minutes = min(RETRY_BASE_MINUTES * 2 ** (attempts - 1), RETRY_MAX_MINUTES)
+    return add_to_date(now(), minutes=minutes)
+
+
+def get_due_retries(limit=100):
+    # failed orders whose backoff has run out, and orders still Processing
+    # under a claim older than CLAIM_TIMEOUT_MINUTES: their run died before
+    # marking them, and the poller's watermark has already moved past them
+    return frappe.db.sql_list("""
+        SELECT name FROM `tabShopify Order Ledger`
+        WHERE (state = 'Failed' AND next_retry_at <= %(now)s)
+        OR (state = 'Processing' AND modified < %(stale)s)
+        ORDER BY COALESCE(next_retry_at, modified) ASC
+        LIMIT %(limit)s
+    """, {
+        "now": now(),
+        "stale": add_to_date(now(), minutes=-CLAIM_TIMEOUT_MINUTES),
+        "limit": cint(limit),
+    })
+
+
+@frappe.whitelist()
+def retry_now(order_id):
+    # also revives orders the retrier has given up on
+    frappe.has_permission("Shopify Order Ledger", "write", throw=True)
+    frappe.db.set_value("Shopify Order Ledger", {"name": order_id, "state": "Failed"}, "next_retry_at", now())
+
+
+def insert_rows(order_ids, state, token=None):
+    timestamp = now()
+    user = frappe.session.user
+    frappe.db.bulk_insert(
+        "Shopify Order Ledger",
+        fields=["name", "shopify_order_id", "payload", "state", "claim_token", "creation", "modified", "owner", "modified_by"],
+        values=[
+            (str(order_id), str(order_id), str(order_id), state, token, timestamp, timestamp, user, user)
+            for order_id in order_ids
+        ],
+        ignore_duplicates=True,
+    )
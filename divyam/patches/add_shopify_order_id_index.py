@@ -0,0 +1,10 @@
+import frappe
+
+
+def execute():
+	# shopify_order_id is a Small Text custom field added by the Shopify
+	# integration, so the index needs a prefix length. It is not unique:
+	# amended Sales Orders keep the Shopify order id of the cancelled original.
+	if not frappe.db.has_column("Sales Order", "shopify_order_id"):
+		return
+	frappe.db.add_index("Sales Order", ["shopify_order_id(20)"], index_name="shopify_order_id_index")
@@ -0,0 +1,58 @@
+import frappe
+from frappe.utils.fixtures import sync_fixtures
+
+
+def execute():
+	# Customers and addresses created before custom_shopify_customer_id existed
+	# were found by name on every order. Match them once here, through the
+	# Sales Orders made from stored payloads and then by name, so ingestion
+	# only ever looks records up by the indexed id.
+	sync_fixtures("divyam")
+	assigned = {
+		doctype: set(frappe.get_all(doctype, filters={"custom_shopify_customer_id": ["is", "set"]}, pluck="custom_shopify_customer_id"))
+		for doctype in ("Customer", "Address")
+	}
+	unassigned = {
+		"Customer": get_unassigned("Customer", "customer_name"),
+		"Address": get_unassigned("Address", "address_title"),
+	}
+	rows = frappe.db.sql("""
+		SELECT
+			JSON_UNQUOTE(JSON_EXTRACT(payload.payload, '$.customer.id')) AS customer_id,
+			CONCAT(
+				JSON_UNQUOTE(JSON_EXTRACT(payload.payload, '$.customer.first_name')), ' ',
+				JSON_UNQUOTE(JSON_EXTRACT(payload.payload, '$.customer.last_name'))
+			) AS customer_name,
+			so.customer, so.customer_address
+		FROM `tabShopify Order Payload` payload
+		LEFT JOIN `tabSales Order` so ON so.shopify_order_id = payload.name
+		WHERE JSON_TYPE(JSON_EXTRACT(payload.payload, '$.customer.id')) IN ('INTEGER', 'UNSIGNED INTEGER', 'STRING')
+		ORDER BY payload.name
+	""", as_dict=True)
+	for row in rows:
+		for doctype, linked in (("Customer", row.customer), ("Address", row.customer_address)):
+			if row.customer_id in assigned[doctype]:
+				continue
+			names, by_title = unassigned[doctype]
+			name = linked if linked in names else by_title.get(row.customer_name)
+			if name not in names:
+				continue
+			frappe.db.set_value(doctype, name, "custom_shopify_customer_id", row.customer_id, update_modified=False)
+			assigned[doctype].add(row.customer_id)
+			names.discard(name)
+
+
+def get_unassigned(doctype, title_field):
+	# the records without a Shopify customer id, and title -> name of the first
+	# of them with that title, which is the one the old lookup found
+	names, by_title = set(), {}
+	for name, title in frappe.get_all(
+		doctype,
+		filters={"custom_shopify_customer_id": ["is", "not set"]},
+		fields=["name", title_field],
+		order_by="creation asc",
+		as_list=True,
+	):
+		names.add(name)
+		by_title.setdefault(title, name)
+	return names, by_title
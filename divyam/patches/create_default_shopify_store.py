@@ -0,0 +1,34 @@
+import frappe
+from frappe.utils.password import get_decrypted_password
+
+# sync state that used to be kept on Divyam Settings for the one store
+SYNC_STATE_FIELDS = (
+	"last_order_updated_at",
+	"last_order_id",
+	"sync_checkpoint",
+	"sync_interval",
+	"next_sync_at",
+	"last_sync_orders",
+)
+
+
+def execute():
+	settings = frappe.get_single("Divyam Settings")
+	if settings.stores:
+		return
+	# the fields are gone from the doctype but their values are still in tabSingles
+	values = dict(frappe.db.sql(
+		"""SELECT field, value FROM `tabSingles` WHERE doctype = 'Divyam Settings' AND field IN %(fields)s""",
+		{"fields": SYNC_STATE_FIELDS},
+	))
+	# the token sat on Divyam Settings for a while and on Shopify Settings before that
+	token = get_decrypted_password("Divyam Settings", "Divyam Settings", "shopify_key", raise_exception=False)
+	if not token and frappe.db.exists("DocType", "Shopify Settings"):
+		token = get_decrypted_password("Shopify Settings", "Shopify Settings", "shopify_key", raise_exception=False)
+	settings.append("stores", {
+		"shop_url": "doeraa.myshopify.com",
+		"enabled": 1,
+		"access_token": token,
+		**{field: values.get(field) for field in SYNC_STATE_FIELDS},
+	})
+	settings.save()
@@ -1,170 +1,608 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+
 from frappe.utils.data import cint
 import requests
 import frappe
-from frappe.utils import getdate, now
+from frappe.utils import add_to_date, flt, get_datetime, getdate, now, now_datetime
+from frappe.utils.background_jobs import get_queue
+from frappe.utils.password import get_decrypted_password
+from erpnext.setup.utils import get_exchange_rate
+
+from divyam.order_ledger import claim_orders, get_due_retries, mark_created, mark_existing, mark_failed
+from divyam.shopify_client import ShopifyClient, get_next_url, parse_json
+from divyam.shopify_transform import (
+    ORDER_FIELDS, SHIPPING_ITEM, WAREHOUSE, build_sales_order, get_date, get_discount, get_shipping_item,
+    get_store_settings, project_order,
+)
+from divyam.sync_run import SyncStats, sync_run
+
+SETTINGS_VERSION_KEY = "divyam:shopify_settings_version"
+# (site, Shopify Store row) -> (settings version, client)
+_clients = {}
+
+STORE_FIELDS = [
+    "name", "shop_url", "enabled", "company", "warehouse", "cost_center", "time_zone", "home_state",
+    "igst_account", "cgst_account", "sgst_account",
+    "last_order_updated_at", "last_order_id", "sync_checkpoint", "sync_interval", "next_sync_at", "last_sync_orders",
+]
+
+
+def get_stores(enabled=True):
+    # the Shopify Store rows of Divyam Settings, in the order they are listed
+    filters = {"parent": "Divyam Settings", "parenttype": "Divyam Settings"}
+    if enabled:
+        filters["enabled"] = 1
+    return frappe.get_all("Shopify Store", filters=filters, fields=STORE_FIELDS, order_by="idx")
+
+def normalize_shop_url(shop_url):
+    # "https://Shop.myshopify.com/" and "shop.myshopify.com" are the same store
+    shop_url = (shop_url or "").strip().lower()
+    for scheme in ("https://", "http://"):
+        shop_url = shop_url.removeprefix(scheme)
+    return shop_url.rstrip("/")
+
+def get_store(store=None):
+    # store is a Shopify Store row, its name or its shop url; nothing means the
+    # first enabled store
+    if isinstance(store, dict):
+        return store
+    if not store:
+        stores = get_stores()
+        if not stores:
+            frappe.throw("Add an enabled Shopify Store to Divyam Settings")
+        return stores[0]
+    shop_url = normalize_shop_url(store)
+    for row in get_stores(enabled=False):
+        if store == row.name or shop_url == normalize_shop_url(row.shop_url):
+            return row
+    frappe.throw(f"Shopify Store {store} is not set up in Divyam Settings")
+
+def get_client(store=None):
+    # Every call to a shop goes through that shop's client so they share one
+    # connection pool and one rate limit bucket; stores have separate buckets,
+    # as Shopify limits each shop on its own. A client is built on first use
+    # and each worker keeps it until Divyam Settings is saved again, which
+    # costs one cache lookup per call instead of a DB read and password
+    # decryption.
+    store = get_store(store)
+    version = frappe.cache().get_value(SETTINGS_VERSION_KEY, generator=lambda: frappe.generate_hash(length=10))
+    key = (frappe.local.site, store.name)
+    cached = _clients.get(key)
+    if not cached or cached[0] != version:
+        token = get_decrypted_password("Shopify Store", store.name, "access_token", raise_exception=False)
+        cached = _clients[key] = (version, ShopifyClient(store.shop_url, token))
+    return cached[1]
 
-setting = frappe.get_doc("Shopify Settings")
-api_key = setting.get_password("shopify_key")
+def clear_client_cache():
+    # called when Divyam Settings is saved; every worker rebuilds its client on next use
+    frappe.cache().delete_value(SETTINGS_VERSION_KEY)
 
 
 @frappe.whitelist()
 def set_shopify():
-    base_url = "https://doeraa.myshopify.com/admin/api/2021-04/orders.json"
-    headers = {
-        "X-Shopify-Access-Token": api_key,
-    }
-    orders = []
-    url = f"{base_url}?limit=250"
-    while url:
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()  # Raise an exception for 4xx or 5xx status codes
-            response_data = response.json()
-            orders.extend(response_data.get('orders', []))
-            
-            # Get the 'Link' header from the response headers
-            link_header = response.headers.get('Link')
-            if link_header:
-                # Parse the 'Link' header to find the next page URL
-                links = link_header.split(',')
-                next_url = None
-                for link in links:
-                    if 'rel="next"' in link:
-                        next_url = link[link.find('<') + 1:link.find('>')]
-                        break
-                url = next_url
-            else:
-                url = None
-        except requests.exceptions.RequestException as e:
-            frappe.log_error(f"Error fetching Shopify data: {e}")
-            break
-    return orders
+    return [order for orders in iter_orders() for order in orders]
+
+def iter_orders(store=None):
+    return iter_pages("orders.json", {"limit": 250}, store)
 
 @frappe.whitelist()
 def syn_order():
     order_id = '#84650'
-    base_url = f"https://doeraa.myshopify.com/admin/api/2021-04/orders/{order_id}.json"
-    headers = {
-        "X-Shopify-Access-Token": api_key
-    }
-    response = requests.get(base_url, headers=headers)
-    response.raise_for_status()  # This will raise an HTTPError for bad responses
-    order_data = response.json().get('order')
+    response = get_client().get(f"orders/{order_id}.json")
+    order_data = parse_json(response).get('order')
     return order_data
     
 @frappe.whitelist()
-def sync_orders():
-    unsync_orders = ["#88721", "#88722", "#88723", "#88724", "#88725", "#88726", "#88727", "#88728", "#88729", "#88730", "#88731", "#88732", "#88733", "#88734"]
-    orders = []
-    
-    for order_id in unsync_orders:
-        base_url = f"https://doeraa.myshopify.com/admin/api/2021-04/orders/{order_id}.json"
-        headers = {
-            "X-Shopify-Access-Token": api_key
-        }
-        response = requests.get(base_url, headers=headers)
-        response.raise_for_status()
-        order_data = response.json().get('order')
-        orders.append(order_data)
-    
-    return orders
+def sync_orders(orders, store=None):
+    # Fetch and ingest an explicit list of orders of one store, e.g. the ones
+    # missed during an outage. Plain numbers are Shopify order ids and are
+    # fetched 250 at a time with the ids filter; order names such as "#88721"
+    # can only be looked up one by one, so those are fetched concurrently.
+    store = get_store(store)
+    if isinstance(orders, str):
+        orders = frappe.parse_json(orders)
+    order_ids = [str(order) for order in orders if str(order).isdigit()]
+    order_names = [str(order) for order in orders if not str(order).isdigit()]
+
+    # the worker threads have no site context, so they are handed the client
+    client = get_client(store)
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        futures = [
+            executor.submit(fetch_orders_by_id, order_ids[i:i + 250], client)
+            for i in range(0, len(order_ids), 250)
+        ] + [executor.submit(fetch_order_by_name, name, client) for name in order_names]
+
+        fetched = []
+        for future in futures:
+            try:
+                fetched.extend(future.result())
+            except requests.exceptions.RequestException as e:
+                frappe.log_error(f"Error fetching Shopify data: {e}")
+
+    save_snapshots(fetched, store.shop_url)
+    with sync_run(f"divyam.shopify.sync_orders {store.shop_url}") as stats:
+        return create_sales_order(fetched, stats=stats, store=store)
+
+# concurrent requests used by sync_orders; the shared rate limit bucket keeps
+# them within the shop's limit
+SYNC_WORKERS = 4
+
+def fetch_orders_by_id(order_ids, client=None):
+    return fetch_page("orders.json", {"ids": ",".join(order_ids), "status": "any", "limit": 250}, client=client)[0]
+
+def fetch_order_by_name(name, client=None):
+    return fetch_page("orders.json", {"name": name, "status": "any"}, client=client)[0][:1]
+
+# first order date the scheduled sync looks at when no watermark is stored yet
+SYNC_START = "2023-04-01T00:00:00Z"
+
+
+def poll_shopify():
+    # Ticks every minute and queues a sync job for every store whose
+    # next_sync_at, set by its previous run, has passed. Each store syncs in
+    # its own job on the long queue, so the stores run side by side and a slow
+    # store only holds up itself.
+    timeout = get_sync_lock_timeout()
+    for store in get_stores():
+        if store.next_sync_at and get_datetime(store.next_sync_at) > now_datetime():
+            continue
+        frappe.enqueue(
+            "divyam.shopify.get_shopify_data",
+            queue="long",
+            timeout=timeout,
+            job_id=f"shopify_sync::{store.shop_url}",
+            deduplicate=True,
+            store=store.name,
+        )
 
 @frappe.whitelist()
-def get_shopify_data():
-   
-    base_url = "https://doeraa.myshopify.com/admin/api/2021-04/orders.json"
-    headers = {
-        "X-Shopify-Access-Token": api_key
+def get_shopify_data(store=None):
+    # a run can outlast the polling interval; the store's lock keeps the next
+    # tick from starting a second copy. A run that could not fetch from
+    # Shopify raises and is not scheduled, so it is not mistaken for an empty one.
+    store = get_store(store)
+    lock = acquire_sync_lock(store)
+    if not lock:
+        return []
+    try:
+        with sync_run(f"divyam.shopify.get_shopify_data {store.shop_url}") as stats:
+            sales_order_names = sync_new_orders(lock, stats, store)
+        # updated_at_min is inclusive, so every run sees the last order it already
+        # has again; only orders that were not skipped as existing are new
+        schedule_next_sync(store, stats.orders_seen - stats.orders_skipped)
+        return sales_order_names
+    finally:
+        release_sync_lock(lock)
+
+# a sync that sees at least this many orders is busy and polls again at the minimum interval
+BUSY_SYNC_ORDERS = 50
+
+def schedule_next_sync(store, orders_found):
+    # back off while the store has nothing new and tighten again as soon as orders come in
+    settings = frappe.db.get_singles_dict("Divyam Settings")
+    min_interval = max(cint(settings.get("min_sync_interval")) or 60, 60)
+    max_interval = max(cint(settings.get("max_sync_interval")) or 900, min_interval)
+    interval = cint(frappe.db.get_value("Shopify Store", store.name, "sync_interval")) or min_interval
+    if not orders_found:
+        interval *= 2
+    elif orders_found >= BUSY_SYNC_ORDERS:
+        interval = min_interval
+    else:
+        interval //= 2
+    interval = min(max(interval, min_interval), max_interval)
+    frappe.db.set_value("Shopify Store", store.name, {
+        "sync_interval": interval,
+        # a few seconds early so the minute tick at the due time is not missed
+        "next_sync_at": add_to_date(now_datetime(), seconds=interval - 5),
+        "last_sync_orders": orders_found,
+    })
+    frappe.db.set_single_value("Divyam Settings", "pending_orders", get_pending_order_count())
+    frappe.db.commit()
+    return interval
+
+def get_pending_order_count():
+    return frappe.db.count("Shopify Order Ledger", {"state": ["in", ["Received", "Processing"]]})
+
+@frappe.whitelist()
+def get_sync_status():
+    # what operations look at to see how far behind the sync is
+    frappe.only_for("System Manager")
+    ledger = dict(frappe.get_all(
+        "Shopify Order Ledger",
+        filters={"state": ["in", ["Received", "Processing", "Failed"]]},
+        fields=["state", "count(name) as count"],
+        group_by="state",
+        as_list=True,
+    ))
+    return {
+        "stores": {
+            store.shop_url: {
+                "sync_running": bool(frappe.cache().get(get_sync_lock_key(store))),
+                "sync_interval": cint(store.sync_interval),
+                "next_sync_at": store.next_sync_at,
+                "last_sync_orders": cint(store.last_sync_orders),
+                "last_order_updated_at": store.last_order_updated_at,
+            }
+            for store in get_stores()
+        },
+        "orders_by_state": ledger,
+        "pending_orders": ledger.get("Received", 0) + ledger.get("Processing", 0),
+        "queued_jobs": {queue: get_queue(queue).count for queue in ("short", "default", "long")},
     }
-    orders = []
-    # # All orders except draft
-    url = f"{base_url}?limit=10"
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    orders = response.json()
-
-    #remove duplicate items from the sales order
-    
-    return create_sales_order(orders.get('orders', []))
-    
 
-def create_sales_order(orders):
+def sync_new_orders(lock, stats, store):
+    checkpoint = store.sync_checkpoint
+    if checkpoint:
+        # resume an interrupted run from the page it stopped at
+        path, params = checkpoint, None
+    else:
+        # only ask for orders changed since the last successfully ingested one
+        path, params = "orders.json", {
+            "updated_at_min": store.last_order_updated_at or SYNC_START,
+            "order": "updated_at asc",
+            "limit": 250,
+        }
+
     sales_order_names = []
-    for order in orders:
-        try:
-            # Check if sales order exists; if not, then create
-            if frappe.db.exists("Sales Order", {"shopify_order_id": order.get("id")}):
-                continue
-            customer_data = order.get("customer")
-            if not customer_data:
-                frappe.log_error(f"No customer data for order {order.get('id')}")
+    # Shopify customer id -> Customer / Address names, shared by all pages of the run
+    customer_cache = {}
+    pages = OrderPages(path, params, stats, store)
+    for orders, next_url in pages:
+        sales_order_names.extend(create_sales_order(orders, customer_cache=customer_cache, stats=stats, store=store))
+        update_watermark(store, orders)
+        save_checkpoint(store, next_url)
+        refresh_sync_lock(lock)
+    if pages.error:
+        if checkpoint and not pages.fetched:
+            # the stored cursor is no longer accepted; start over from the watermark
+            save_checkpoint(store, None)
+        # a revoked token or an outage fails the run instead of looking idle
+        raise pages.error
+    return sales_order_names
+
+def save_checkpoint(store, next_url):
+    frappe.db.set_value("Shopify Store", store.name, "sync_checkpoint", next_url)
+    frappe.db.commit()
+
+SYNC_LOCK_KEY = "divyam:shopify_sync_lock"
+
+def get_sync_lock_key(store):
+    return frappe.cache().make_key(f"{SYNC_LOCK_KEY}:{store.shop_url}")
+
+def get_sync_lock_timeout():
+    return cint(frappe.db.get_single_value("Divyam Settings", "sync_lock_timeout")) or 1800
+
+def acquire_sync_lock(store):
+    # Redis SET NX with an expiry: a worker that dies while holding the lock only
+    # blocks the store's sync until the lock times out
+    timeout = get_sync_lock_timeout()
+    key = get_sync_lock_key(store)
+    token = frappe.generate_hash(length=16)
+    if frappe.cache().set(key, token, nx=True, ex=timeout):
+        return {"key": key, "token": token, "timeout": timeout}
+    return None
+
+# Compare and act in one script: with a separate get the lock could expire and
+# be taken by another worker between the check and the expire or delete.
+REFRESH_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+def refresh_sync_lock(lock):
+    return frappe.cache().eval(REFRESH_LOCK_SCRIPT, 1, lock["key"], lock["token"], lock["timeout"] * 1000)
+
+def release_sync_lock(lock):
+    return frappe.cache().eval(RELEASE_LOCK_SCRIPT, 1, lock["key"], lock["token"])
+
+@frappe.whitelist()
+def retry_failed_orders():
+    # Scheduled retrier for the dead letter queue: failed orders whose backoff
+    # has run out, and orders abandoned by a run that died while holding their
+    # claim, are created again from their stored payload, without
+    # fetching anything from Shopify. Each order is created with the settings
+    # of the store it came from.
+    order_ids = get_due_retries(RETRY_BATCH_SIZE)
+    if not order_ids:
+        return []
+    orders_by_store = {}
+    for payload, shop_url in frappe.get_all(
+        "Shopify Order Payload", filters={"name": ["in", order_ids]}, fields=["payload", "shop_url"], as_list=True
+    ):
+        orders_by_store.setdefault(shop_url, []).append(frappe.parse_json(payload))
+    sales_order_names = []
+    with sync_run("divyam.shopify.retry_failed_orders") as stats:
+        for shop_url, orders in orders_by_store.items():
+            try:
+                store = get_store(shop_url)
+            except frappe.ValidationError as e:
+                # a shop that was removed from the settings; its orders back off like any failure
+                mark_failed([o.get("id") for o in orders], frappe.get_traceback(), type(e).__name__)
                 continue
-            
-            customer_name = f"{customer_data.get('first_name')} {customer_data.get('last_name')}"
-            customer = create_customer(customer_name)
-            address = get_address(order, customer_name)
-            items = get_items(order)
-            taxes = get_taxes(order)
-            sales_order = frappe.get_doc({
-                "doctype": "Sales Order",
-                "company": "Doeraa Private Limited",
-                "customer": customer,
-                "customer_address": address,
-                "items": items,
-                "tax_category": get_tax_category(order),
-                "taxes": taxes,
-                "delivery_date": now(),
-                'transaction_date': getdate(order.get('created_at')),
-                'shopify_order_id': order.get('id'),
-                'shopify_order_number': order.get('name'),
-                "discount_amount": calculate_discount(order),
-                
+            sales_order_names.extend(create_sales_order(orders, stats=stats, store=store))
+    return sales_order_names
+
+RETRY_BATCH_SIZE = 200
+
+def iter_pages(path, params=None, store=None):
+    for orders, _next_url in OrderPages(path, params, store=store):
+        yield orders
+
+class OrderPages:
+    # Yields (orders, next page url) one page at a time from one store; the
+    # next page is downloaded in the background while the caller is busy with
+    # the current one. error is set when the download stopped because of a
+    # request error.
+    def __init__(self, path, params=None, stats=None, store=None):
+        self.path = path
+        self.params = params
+        self.stats = stats or SyncStats()
+        self.store = get_store(store)
+        self.client = get_client(self.store)
+        self.fetched = 0
+        self.error = None
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch_page, self.path, self.params, self.stats, self.client)
+            while future:
+                try:
+                    orders, next_url = future.result()
+                except requests.exceptions.RequestException as e:
+                    self.error = e
+                    frappe.log_error(f"Error fetching Shopify data: {e}")
+                    return
+                # the next url already carries the query of the first request
+                future = executor.submit(fetch_page, next_url, None, self.stats, self.client) if next_url else None
+                self.fetched += 1
+                self.stats.pages += 1
+                save_snapshots(orders, self.store.shop_url)
+                yield orders, next_url
+
+def fetch_page(path, params=None, stats=None, client=None):
+    stats = stats or SyncStats()
+    client = client or get_client()
+    # only the first request carries params, the next urls repeat them
+    if params is not None:
+        params = {"fields": ORDER_FIELDS, **params}
+    with stats.timer("http"):
+        response = client.get(path, params=params)
+    stats.bytes += len(response.content)
+    with stats.timer("json"):
+        orders = parse_json(response).get('orders', [])
+    return orders, get_next_url(response)
+
+def save_snapshots(orders, shop_url=None):
+    # Keep the latest payload of every order fetched from Shopify so repair jobs
+    # can replay them without downloading the history again. Unchanged payloads
+    # are recognised by their hash and not written again. Returns the ids of
+    # new or changed orders.
+    snapshots = {}
+    for order in orders:
+        payload = json.dumps(project_order(order), sort_keys=True, separators=(",", ":"))
+        content_hash = hashlib.sha1(payload.encode()).hexdigest()
+        snapshots[str(order.get("id"))] = (payload, content_hash, order.get("updated_at"))
+    if not snapshots:
+        return []
+
+    existing = dict(frappe.get_all(
+        "Shopify Order Payload",
+        filters={"name": ["in", list(snapshots)]},
+        fields=["name", "content_hash"],
+        as_list=True,
+    ))
+    timestamp = now()
+    new_rows = []
+    changed = []
+    for order_id, (payload, content_hash, updated_at) in snapshots.items():
+        if order_id not in existing:
+            new_rows.append((
+                order_id, order_id, shop_url, payload, content_hash, updated_at,
+                timestamp, timestamp, frappe.session.user, frappe.session.user,
+            ))
+        elif existing[order_id] != content_hash:
+            frappe.db.set_value("Shopify Order Payload", order_id, {
+                "payload": payload,
+                "content_hash": content_hash,
+                "updated_at": updated_at,
+                "shop_url": shop_url,
             })
-            frappe.flags.ignore_validate = True
-            sales_order.insert(ignore_permissions=True)
-            create_shipping_charges(order)
-            frappe.db.commit()
+        else:
+            continue
+        changed.append(order_id)
+
+    if new_rows:
+        frappe.db.bulk_insert(
+            "Shopify Order Payload",
+            ["name", "shopify_order_id", "shop_url", "payload", "content_hash", "updated_at",
+                "creation", "modified", "owner", "modified_by"],
+            new_rows,
+            ignore_duplicates=True,
+        )
+    return changed
+
+def update_watermark(store, orders):
+    # orders arrive sorted by updated_at; failed orders are retried from the
+    # ledger by retry_failed_orders, so the watermark does not wait for them
+    if not orders:
+        return
+    last = orders[-1]
+    frappe.db.set_value("Shopify Store", store.name, {
+        "last_order_updated_at": last.get("updated_at"),
+        "last_order_id": str(last.get("id")),
+    })
+    frappe.db.commit()
+
+def get_existing_order_ids(orders):
+    # one query per page instead of an exists() round trip per order
+    order_ids = [str(order.get("id")) for order in orders if order.get("id")]
+    if not order_ids:
+        return set()
+    return set(frappe.get_all(
+        "Sales Order",
+        filters={"shopify_order_id": ["in", order_ids]},
+        pluck="shopify_order_id",
+    ))
+
+def create_sales_order(orders, failed=None, customer_cache=None, stats=None, store=None):
+    stats = stats or SyncStats()
+    if failed is None:
+        failed = set()
+    failed_before = len(failed)
+    # Shopify order id -> (error class, traceback) of the orders that failed
+    errors = {}
+    sales_order_names = []
+    with stats.timer("master_data"):
+        existing_order_ids = get_existing_order_ids(orders)
+        mark_existing(existing_order_ids)
+        # the webhook may be creating some of these right now; only claimed orders go ahead
+        claimed = claim_orders(o.get("id") for o in orders if str(o.get("id")) not in existing_order_ids)
+        new_orders = [o for o in orders if str(o.get("id")) in claimed]
+        create_missing_items(new_orders)
+        if customer_cache is None:
+            customer_cache = {}
+        prefetch_customers(new_orders, customer_cache)
+        masters = resolve_masters(new_orders, customer_cache, failed, errors)
+
+    # orders are committed in chunks; each order gets its own savepoint so a
+    # failing order, malformed payloads included, is rolled back alone
+    orders_per_commit = get_orders_per_commit()
+    today = getdate()
+    store_settings, exchange_rates = get_currency_settings(store, new_orders, today)
+    pending = 0
+    for order in new_orders:
+        resolved = masters.get(str(order.get("id")))
+        if not resolved:
+            continue
+        frappe.db.savepoint("shopify_order")
+        try:
+            with stats.timer("insert"):
+                values = build_sales_order(order, resolved[0], resolved[1], today, store_settings, exchange_rates)
+                sales_order = frappe.get_doc(values)
+                frappe.flags.ignore_validate = True
+                # shipping and discount are part of the document, so each order is a single insert
+                sales_order.insert(ignore_permissions=True)
+                mark_created(order.get("id"), sales_order.name)
             sales_order_names.append(sales_order.name)
+            claimed.discard(str(order.get("id")))
         except Exception as e:
+            frappe.db.rollback(save_point="shopify_order")
             frappe.log_error(f"Error creating sales order: {e}")
+            failed.add(order.get("id"))
+            errors[str(order.get("id"))] = (type(e).__name__, frappe.get_traceback())
+        pending += 1
+        if pending >= orders_per_commit:
+            with stats.timer("commit"):
+                frappe.db.commit()
+            pending = 0
+    # every claimed order that was not created goes to the dead letter queue
+    for order_id in claimed:
+        error_class, error = errors.get(order_id, (None, None))
+        mark_failed([order_id], error, error_class, retry=error_class != MISSING_CUSTOMER)
+    with stats.timer("commit"):
+        frappe.db.commit()
+
+    stats.orders_seen += len(orders)
+    stats.orders_skipped += len(orders) - len(new_orders)
+    stats.orders_created += len(sales_order_names)
+    stats.orders_failed += len(failed) - failed_before
     return sales_order_names
-def calculate_discount(order):
-    discount_codes = order.get('discount_codes', [])
-    if discount_codes:
-        discount = discount_codes[0].get('amount')
-        return discount
-    return 0
-def get_tax_category(order):   
-    province = order.get('billing_address', {}).get('province')
-    if province == "Gujarat":
-        category = "In-state"
-    else:
-        category = "Out-state"
-    return category
 
-@frappe.whitelist()
-def get_items(order):
-    order_items = order.get('line_items', [])
-    items = []
-
-    for item in order_items:
-        # Check if item is available; if not, then create
-        if not frappe.db.exists("Item", item.get('sku')):
-            item_code = item.get('sku')
-            item_name = item.get('name')
+def get_currency_settings(store, orders, today):
+    # the store's settings with its company currency, and the exchange rates
+    # of the orders placed in another currency, looked up once per currency and day
+    settings = get_store_settings(store)
+    settings["currency"] = get_company_currency(settings["company"]) or settings["currency"]
+    exchange_rates = {}
+    for order in orders:
+        currency = order.get("currency")
+        if not currency or currency == settings["currency"]:
+            continue
+        try:
+            key = (currency, get_date(order.get("created_at")) or today)
+        except ValueError:
+            # a malformed date fails the order alone when it is built
+            continue
+        if key not in exchange_rates:
+            exchange_rates[key] = get_exchange_rate(currency, settings["currency"], key[1], "for_selling")
+    return settings, exchange_rates
+
+def get_company_currency(company):
+    return frappe.db.get_value("Company", company, "default_currency", cache=True)
+
+# error class of orders without customer data; the payload will not change on
+# a retry, so they are not retried
+MISSING_CUSTOMER = "MissingCustomer"
+
+def resolve_masters(orders, customer_cache, failed=None, errors=None):
+    # Shopify order id -> (customer, address), creating missing records
+    masters = {}
+    if errors is None:
+        errors = {}
+    for order in orders:
+        customer_data = order.get("customer")
+        if not customer_data:
+            frappe.log_error(f"No customer data for order {order.get('id')}")
+            errors[str(order.get("id"))] = (MISSING_CUSTOMER, f"No customer data for order {order.get('id')}")
+            if failed is not None:
+                failed.add(order.get("id"))
+            continue
+        customer_name = f"{customer_data.get('first_name')} {customer_data.get('last_name')}"
+        frappe.db.savepoint("shopify_order")
+        try:
+            masters[str(order.get("id"))] = (
+                create_customer(customer_data, customer_cache),
+                get_address(order, customer_name, customer_cache),
+            )
+        except Exception as e:
+            frappe.db.rollback(save_point="shopify_order")
+            frappe.log_error(f"Error creating sales order: {e}")
+            errors[str(order.get("id"))] = (type(e).__name__, frappe.get_traceback())
+            if failed is not None:
+                failed.add(order.get("id"))
+    return masters
+
+def get_orders_per_commit():
+    return cint(frappe.db.get_single_value("Divyam Settings", "orders_per_commit")) or 50
+
+# Item Tax rows every Shopify item is created with
+ITEM_TAXES = [
+    {"item_tax_template": "GST 5% - DE", "tax_category": "In-State"},
+    {"item_tax_template": "GST 5% - DE", "tax_category": "Out-State"},
+]
+
+def create_missing_items(orders):
+    # resolve every SKU on the page with one query and create the unknown ones
+    # together in a single commit
+    item_names = {}
+    for order in orders:
+        for item in order.get('line_items', []):
+            if item.get('sku'):
+                item_names.setdefault(item.get('sku'), item.get('name'))
+    if not item_names:
+        return
+    existing = set(frappe.get_all("Item", filters={"name": ["in", list(item_names)]}, pluck="name"))
+    for item_code, item_name in item_names.items():
+        if item_code in existing:
+            continue
+        frappe.db.savepoint("create_item")
+        try:
             create_item(item_code, item_name)
-        
-        items.append({
-            "item_code": item.get('sku'),
-            "item_name": item.get('name')[:140],
-            "rate": item.get('price'),
-            "qty": item.get('quantity'),
-            "warehouse": "Finished Goods - DPL",
-            "delivery_date": now(),
-            "uom": "Meter",
-            "gst_treatment": "Taxable"
-        })
-    return items
+        except Exception as e:
+            # the order using this item fails on its own later
+            frappe.db.rollback(save_point="create_item")
+            frappe.log_error(f"Error creating item {item_code}: {e}")
+    frappe.db.commit()
 
 def create_item(item_code, item_name):
     item = frappe.get_doc({
@@ -173,86 +611,99 @@ def create_item(item_code, item_name):
         "item_name": item_name,
         "item_group": "Products",
         "uom": "Meter",
+        "taxes": ITEM_TAXES,
     })
     item.insert(ignore_permissions=True)
-    frappe.db.commit()
 
-def get_taxes(order):
-    taxes = []
-    tax_included = order.get('taxes_included')
-    tax_category = get_tax_category(order)
-    if tax_category == "Out-state":
-                taxes.append({
-                    "charge_type": "On Net Total",
-                    "account_head": "Output Tax IGST - DPL",
-                    "cost_center": "Main - DPL",
-                    "rate": 5,
-                    "description": "IGST - 5.00%",
-                    "included_in_print_rate": tax_included
-                })
-    else:
-        taxes.append({
-            "charge_type": "On Net Total",
-            "account_head": "Output Tax CGST - DPL",
-            "cost_center": "Main - DPL",
-            "rate": 2.5,
-            "description": "SGST - 2.50%",
-            "included_in_print_rate": tax_included
-        })
-        taxes.append({
-            "charge_type": "On Net Total",
-            "account_head": "Output Tax SGST - DPL",
-            "cost_center": "Main - DPL",
-            "rate": 2.5,
-            "description": "CGST - 2.50%",
-            "included_in_print_rate": tax_included
-        })
-    return taxes
-
-def create_customer(customer_name):
-    if frappe.db.exists("Customer", {"customer_name": customer_name}):
-        customer = frappe.get_doc("Customer", {"customer_name": customer_name})
+def prefetch_customers(orders, customer_cache):
+    # one query per doctype for all Shopify customers on the page that are not
+    # cached yet
+    customer_ids = {
+        str(order["customer"]["id"]) for order in orders
+        if (order.get("customer") or {}).get("id")
+    } - customer_cache.keys()
+    if not customer_ids:
+        return
+    for customer_id in customer_ids:
+        customer_cache[customer_id] = {}
+    for doctype, key in (("Customer", "customer"), ("Address", "address")):
+        for row in frappe.get_all(
+            doctype,
+            filters={"custom_shopify_customer_id": ["in", list(customer_ids)]},
+            fields=["name", "custom_shopify_customer_id"],
+        ):
+            customer_cache[row.custom_shopify_customer_id][key] = row.name
+
+def get_or_create(doctype, customer_id, values, match=None):
+    # Find the record by Shopify customer id and only then insert it; records
+    # from before the id was stored got theirs in the
+    # backfill_shopify_customer_ids patch. The id field is unique, so when the
+    # webhook and the poller race on the same customer the loser reads back
+    # the winner's record. match is only used for orders without a customer id.
+    if customer_id:
+        name = frappe.db.get_value(doctype, {"custom_shopify_customer_id": customer_id})
     else:
-        customer = frappe.get_doc({
-            "doctype": "Customer",
-            "customer_name": customer_name
-        })
-        customer.insert(ignore_permissions=True)
-        frappe.db.commit()
-    return customer.name
+        name = match and frappe.db.get_value(doctype, match)
+    if name:
+        return name
 
-def get_address(order, customer_name):
+    doc = frappe.get_doc({"doctype": doctype, "custom_shopify_customer_id": customer_id, **values})
+    frappe.db.savepoint("shopify_customer")
+    try:
+        doc.insert(ignore_permissions=True)
+    except (frappe.DuplicateEntryError, frappe.UniqueValidationError):
+        frappe.db.rollback(save_point="shopify_customer")
+        name = customer_id and frappe.db.get_value(doctype, {"custom_shopify_customer_id": customer_id})
+        if not name:
+            raise
+        return name
+    return doc.name
+
+def get_cached(customer_cache, customer_id, key, resolve):
+    if not customer_id or customer_cache is None:
+        return resolve()
+    cached = customer_cache.setdefault(customer_id, {})
+    if not cached.get(key):
+        cached[key] = resolve()
+    return cached[key]
+
+def create_customer(customer_data, customer_cache=None):
+    customer_id = customer_data.get("id") and str(customer_data.get("id"))
+    customer_name = f"{customer_data.get('first_name')} {customer_data.get('last_name')}"
+    return get_cached(customer_cache, customer_id, "customer", lambda: get_or_create(
+        "Customer",
+        customer_id,
+        {"customer_name": customer_name},
+        {"customer_name": customer_name},
+    ))
+
+def get_address(order, customer_name, customer_cache=None):
     address = order.get("shipping_address")
     if not address:
         return None
-    
-    if frappe.db.exists("Address", {"address_title": customer_name}):
-        customer_address = frappe.get_doc("Address", {"address_title": customer_name})
-    else:
-        customer_address = frappe.get_doc({
-            "doctype": "Address",
+
+    customer_id = (order.get("customer") or {}).get("id")
+    customer_id = customer_id and str(customer_id)
+    return get_cached(customer_cache, customer_id, "address", lambda: get_or_create(
+        "Address",
+        customer_id,
+        {
             "address_title": customer_name,
             "address_line1": address.get("address1"),
             "city": address.get("city"),
             "state": address.get("province"),
             "country": address.get("country"),
             "pincode": address.get("zip")
-        })
-        customer_address.insert(ignore_permissions=True)
-        frappe.db.commit()
-    return customer_address.name
+        },
+        {"address_title": customer_name},
+    ))
 
 @frappe.whitelist()
 def taxees():
     order_id = "5453587153150"
-    base_url = f"https://doeraa.myshopify.com/admin/api/2021-04/orders/{order_id}.json"
-    headers = {
-        "X-Shopify-Access-Token": api_key
-    }
     try:
-        response = requests.get(base_url, headers=headers)
-        response.raise_for_status()
-        order_data = response.json().get('order')
+        response = get_client().get(f"orders/{order_id}.json")
+        order_data = parse_json(response).get('order')
         tax_lines = order_data.get('tax_lines', [])
         tax_included = order_data.get('taxes_included')
         return {"tax_lines": tax_lines, "tax_included": tax_included}
@@ -261,116 +712,224 @@ def taxees():
         return "Error"
 @frappe.whitelist()
 def update_shipping_carhges(orders):
-     sales_orders = []
-     for order in orders.get('orders', []):
+    # orders is {"orders": [Shopify order payloads]}; their draft Sales Orders
+    # get the shipping line with a single save each
+    if isinstance(orders, str):
+        orders = frappe.parse_json(orders)
+    orders_by_id = {str(order.get("id")): order for order in orders.get('orders', [])}
+    sales_orders = []
+    today = getdate()
+    for name, shopify_order_id in frappe.get_all(
+        "Sales Order",
+        filters={"shopify_order_id": ["in", list(orders_by_id)], "docstatus": 0},
+        fields=["name", "shopify_order_id"],
+        as_list=True,
+    ):
         try:
-            sales_order = frappe.get_doc("Sales Order", {"shopify_order_id": order.get("id"), "docstatus": 0})
-            shipping_lines = order.get('shipping_lines', [])
-            if not shipping_lines:
-                continue
-
-            if shipping_lines:
-                charge = shipping_lines[0].get('price')
-                if float(charge) > 0:
-                    append_item(sales_order, "SHIPPING CHARGES", "SHIPPING CHARGES", charge, 1, "Finished Goods - DPL", getdate(now()), "Nos")
-                sales_orders.append(charge)
-                                   
+            sales_order = frappe.get_doc("Sales Order", name)
+            order = orders_by_id[str(shopify_order_id)]
+            if apply_adjustments(sales_order, order, discount=False, shipping=True, today=today):
+                sales_order.save()
+                frappe.db.commit()
+                sales_orders.append(order.get('shipping_lines')[0].get('price'))
         except Exception as e:
             frappe.log_error(f"Error updating shipping charges: {e}")
-     return sales_orders
-def append_item(sales_order, item_code, item_name, rate, qty, warehouse, delivery_date, uom):
-    sales_order.append("items", {
-        "item_code": item_code,
-        "item_name": item_name,
-        "rate": rate,
-        "qty": qty,
-        "warehouse": warehouse,
-        "delivery_date": delivery_date,
-        "uom": uom
-    })
-    sales_order.save()
-    frappe.db.commit()
- 
+    return sales_orders
+
 @frappe.whitelist()
-def shipping_charges():   
-    base_url = "https://doeraa.myshopify.com/admin/api/2021-04/orders.json"
-    headers = {
-        "X-Shopify-Access-Token": api_key
-    }
-    orders = []
-    # # All orders except draft
-    url = f"{base_url}?limit=250"
-    while url:
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()  # Raise an exception for 4xx or 5xx status codes
-            response_data = response.json()
-            orders.extend(response_data.get('orders', []))
-            
-            # Get the 'Link' header from the response headers
-            link_header = response.headers.get('Link')
-            if link_header:
-                # Parse the 'Link' header to find the next page URL
-                links = link_header.split(',')
-                next_url = None
-                for link in links:
-                    if 'rel="next"' in link:
-                        next_url = link[link.find('<') + 1:link.find('>')]
-                        break
-                url = next_url
-            else:
-                url = None
-        except requests.exceptions.RequestException as e:
-            frappe.log_error(f"Error fetching Shopify data: {e}")
-            break
-    return update_shipping_carhges({"orders": orders})
+def shipping_charges(refresh=False):
+    return apply_order_adjustments(discount=False, shipping=True, refresh=refresh)
 
 def remove_duplicate_items(sales_order):
-    items = sales_order.get("items")
-    item_codes = []
-    for item in items:
-        if item.get("item_code") not in item_codes:
-            item_codes.append(item.get("item_code"))
+    # keeps the first line of every item code; returns how many lines were dropped
+    seen = set()
+    duplicates = []
+    for item in sales_order.get("items"):
+        if item.get("item_code") in seen:
+            duplicates.append(item)
         else:
-            sales_order.remove(item)
-    return sales_order
+            seen.add(item.get("item_code"))
+    for item in duplicates:
+        sales_order.remove(item)
+    return len(duplicates)
 
 @frappe.whitelist()
 def remove_item():
-    # get last 10 orders
-    # orders = frappe.get_all("Sales Order", filters={"docstatus": 0}, order_by="creation desc", limit=10)
-    orders = frappe.get_all("Sales Order", filters={"docstatus": 0})
-    for order in orders:
-        sales_order_doc = frappe.get_doc("Sales Order", order.name)
-        sales_order = remove_duplicate_items(sales_order_doc)
-        sales_order.save()
+    # Only draft orders that really have an item code on more than one line
+    # are loaded and saved, in a background job on the long queue
+    order_names = get_orders_with_duplicate_items()
+    if order_names:
+        frappe.enqueue(
+            "divyam.shopify.remove_duplicate_items_from_orders",
+            queue="long",
+            timeout=4 * 60 * 60,
+            job_id="shopify_repair::remove_duplicate_items",
+            deduplicate=True,
+            order_names=order_names,
+        )
+    frappe.msgprint(f"Removing duplicate items from {len(order_names)} Sales Orders in the background")
+    return len(order_names)
+
+def get_orders_with_duplicate_items():
+    order_names = frappe.db.sql_list("""
+        SELECT soi.parent
+        FROM `tabSales Order Item` soi
+        INNER JOIN `tabSales Order` so ON so.name = soi.parent
+        WHERE so.docstatus = 0 AND soi.parenttype = 'Sales Order'
+        GROUP BY soi.parent, soi.item_code
+        HAVING COUNT(*) > 1
+    """)
+    # an order with several duplicated item codes is listed once per code
+    return list(dict.fromkeys(order_names))
+
+REPAIR_CHUNK_SIZE = 100
+
+def remove_duplicate_items_from_orders(order_names):
+    # commits every chunk so no draft stays locked for the whole run
+    counts = {"changed": 0, "skipped": 0, "failed": 0}
+    for start in range(0, len(order_names), REPAIR_CHUNK_SIZE):
+        for name in order_names[start:start + REPAIR_CHUNK_SIZE]:
+            frappe.db.savepoint("shopify_repair")
+            try:
+                sales_order = frappe.get_doc("Sales Order", name)
+                if sales_order.docstatus != 0 or not remove_duplicate_items(sales_order):
+                    counts["skipped"] += 1
+                    continue
+                sales_order.save()
+                counts["changed"] += 1
+            except Exception as e:
+                frappe.db.rollback(save_point="shopify_repair")
+                frappe.log_error(f"Error removing duplicate items from {name}: {e}")
+                counts["failed"] += 1
         frappe.db.commit()
-        frappe.msgprint("Items removed successfully")
-    return "Items removed successfully"
+        done = min(start + REPAIR_CHUNK_SIZE, len(order_names))
+        frappe.publish_progress(
+            done * 100 / len(order_names),
+            title="Removing duplicate items",
+            description=f"{done} of {len(order_names)} Sales Orders checked: "
+                f"{counts['changed']} changed, {counts['skipped']} skipped, {counts['failed']} failed",
+        )
+    return counts
 #create discount
 @frappe.whitelist()
-def create_discount():
-    orders = set_shopify()
-    discount_codes = []
-    for o in orders:
-        discount_code = o.get('discount_codes', [])
-        if discount_code:
-            discount = discount_code[0].get('amount')
-            discount_codes.append(discount)
-            doc = frappe.get_doc("Sales Order", {"shopify_order_id": o.get("id"), "docstatus": 0})
-            doc.apply_discount_on = "Grand Total"
-            doc.discount_amount = cint(discount)
-            doc.save()
-            frappe.db.commit()
-    return discount_codes
-    
-def create_shipping_charges(order):
-    doc = frappe.get_doc("Sales Order", {"shopify_order_id": order.get("id")})
-    shipping_lines = order.get('shipping_lines', [])
-    if  shipping_lines:
-        charge = shipping_lines[0].get('price')
-        if float(charge) > 0:
-            append_item(doc, "SHIPPING CHARGES", "SHIPPING CHARGES", charge, 1, "Finished Goods - DPL", getdate(now()), "Nos")
-            doc.save()
-            frappe.db.commit()
-    
\ No newline at end of file
+def create_discount(refresh=False):
+    return apply_order_adjustments(discount=True, shipping=False, refresh=refresh)
+
+# draft orders whose Shopify payload has a discount the Sales Order lacks
+MISSING_DISCOUNT = """(
+    so.discount_amount = 0
+    AND JSON_LENGTH(payload.payload, '$.discount_codes') > 0
+)"""
+# draft orders whose Shopify payload has a shipping charge but no shipping line
+MISSING_SHIPPING = """(
+    CAST(JSON_UNQUOTE(JSON_EXTRACT(payload.payload, '$.shipping_lines[0].price')) AS DECIMAL(18, 2)) > 0
+    AND NOT EXISTS (
+        SELECT 1 FROM `tabSales Order Item` soi
+        WHERE soi.parent = so.name AND soi.parenttype = 'Sales Order' AND soi.item_code = %(shipping_item)s
+    )
+)"""
+
+@frappe.whitelist()
+def apply_order_adjustments(discount=True, shipping=True, refresh=False):
+    # Back-applies Shopify discounts and shipping charges to draft Sales Orders
+    # that are missing them, in a background job. With refresh the stored
+    # payloads are downloaded again first, inside the job.
+    discount, shipping, refresh = cint(discount), cint(shipping), cint(refresh)
+    order_names = None if refresh else get_orders_missing_adjustments(discount, shipping)
+    if order_names is None or order_names:
+        frappe.enqueue(
+            "divyam.shopify.apply_adjustments_to_orders",
+            queue="long",
+            timeout=4 * 60 * 60,
+            job_id="shopify_repair::apply_order_adjustments",
+            deduplicate=True,
+            order_names=order_names,
+            discount=discount,
+            shipping=shipping,
+            refresh=refresh,
+        )
+    if order_names is None:
+        frappe.msgprint("Refreshing Shopify orders and applying discounts and shipping charges in the background")
+        return None
+    frappe.msgprint(f"Applying discounts and shipping charges to {len(order_names)} Sales Orders in the background")
+    return len(order_names)
+
+def get_orders_missing_adjustments(discount=True, shipping=True):
+    # one join of the draft Sales Orders against their stored Shopify payloads
+    conditions = []
+    if discount:
+        conditions.append(MISSING_DISCOUNT)
+    if shipping:
+        conditions.append(MISSING_SHIPPING)
+    if not conditions:
+        return []
+    return frappe.db.sql_list(f"""
+        SELECT so.name
+        FROM `tabSales Order` so
+        INNER JOIN `tabShopify Order Payload` payload ON payload.name = so.shopify_order_id
+        WHERE so.docstatus = 0 AND ({" OR ".join(conditions)})
+        ORDER BY so.name
+    """, {"shipping_item": SHIPPING_ITEM})
+
+def apply_adjustments_to_orders(order_names=None, discount=1, shipping=1, refresh=0):
+    if order_names is None:
+        if refresh:
+            # downloading the orders stores their latest payloads
+            for store in get_stores():
+                for _orders in iter_orders(store=store):
+                    pass
+        order_names = get_orders_missing_adjustments(discount, shipping)
+
+    counts = {"changed": 0, "skipped": 0, "failed": 0}
+    today = getdate()
+    for start in range(0, len(order_names), REPAIR_CHUNK_SIZE):
+        chunk = order_names[start:start + REPAIR_CHUNK_SIZE]
+        payloads = dict(frappe.db.sql("""
+            SELECT so.name, payload.payload
+            FROM `tabSales Order` so
+            INNER JOIN `tabShopify Order Payload` payload ON payload.name = so.shopify_order_id
+            WHERE so.name IN %(names)s
+        """, {"names": chunk}))
+        for name in chunk:
+            frappe.db.savepoint("shopify_repair")
+            try:
+                sales_order = frappe.get_doc("Sales Order", name)
+                if sales_order.docstatus != 0 or name not in payloads or not apply_adjustments(
+                    sales_order, frappe.parse_json(payloads[name]), discount, shipping, today
+                ):
+                    counts["skipped"] += 1
+                    continue
+                # discount and shipping together, one save per order
+                sales_order.save()
+                counts["changed"] += 1
+            except Exception as e:
+                frappe.db.rollback(save_point="shopify_repair")
+                frappe.log_error(f"Error applying Shopify adjustments to {name}: {e}")
+                counts["failed"] += 1
+        frappe.db.commit()
+        done = min(start + REPAIR_CHUNK_SIZE, len(order_names))
+        frappe.publish_progress(
+            done * 100 / len(order_names),
+            title="Applying discounts and shipping charges",
+            description=f"{done} of {len(order_names)} Sales Orders checked: "
+                f"{counts['changed']} changed, {counts['skipped']} skipped, {counts['failed']} failed",
+        )
+    return counts
+
+def apply_adjustments(sales_order, order, discount, shipping, today):
+    # returns whether the Sales Order was changed
+    changed = False
+    if shipping and not any(item.item_code == SHIPPING_ITEM for item in sales_order.items):
+        # shipped from the warehouse of the order's own lines, i.e. its store's
+        warehouse = next((item.warehouse for item in sales_order.items if item.warehouse), WAREHOUSE)
+        shipping_item = get_shipping_item(order, today, warehouse)
+        if shipping_item:
+            sales_order.append("items", shipping_item)
+            changed = True
+    if discount and not flt(sales_order.discount_amount):
+        amount = flt(get_discount(order))
+        if amount:
+            sales_order.apply_discount_on = "Grand Total"
+            sales_order.discount_amount = amount
+            changed = True
+    return changed
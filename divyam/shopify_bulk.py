@@ -0,0 +1,218 @@
+#export orders through a Shopify GraphQL bulk operation
+# Shopify runs the query on its side and hands back the URL of a JSONL file:
+# one object per line, with the line items of an order on their own lines
+# after it, pointing back through __parentId. The file is streamed and turned
+# into the REST shaped orders the rest of the sync works with, so a history of
+# any size is never held in memory at once.
+import json
+import time
+
+import requests
+
+BULK_ORDERS_QUERY = """
+{
+  orders(query: "%s", sortKey: CREATED_AT) {
+    edges {
+      node {
+        id
+        name
+        createdAt
+        updatedAt
+        currencyCode
+        taxesIncluded
+        discountCodes
+        totalDiscountsSet { shopMoney { amount } }
+        shippingLine { originalPriceSet { shopMoney { amount } } }
+        customer {
+          id
+          email
+          firstName
+          lastName
+          phone
+          defaultAddress { firstName lastName address1 address2 city province country zip phone }
+        }
+        billingAddress { firstName lastName address1 address2 city province country zip phone }
+        shippingAddress { firstName lastName address1 address2 city province country zip phone }
+        lineItems {
+          edges {
+            node {
+              id
+              sku
+              name
+              quantity
+              originalUnitPriceSet { shopMoney { amount } }
+              taxLines { title rate priceSet { shopMoney { amount } } }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+RUN_BULK_QUERY = """
+mutation bulkOperationRunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+CURRENT_BULK_OPERATION = """
+{
+  currentBulkOperation { id status errorCode objectCount url }
+}
+"""
+
+FINISHED = ("COMPLETED", "FAILED", "CANCELED", "EXPIRED")
+
+
+class BulkOperationError(Exception):
+    pass
+
+
+def export_orders(client, search, poll_interval=10, timeout=6 * 60 * 60, sleep=time.sleep):
+    # starts the export and waits for it; returns the url of the JSONL file, or
+    # None when no order matched
+    start_bulk_operation(client, BULK_ORDERS_QUERY % search.replace('"', '\\"'))
+    waited = 0
+    while True:
+        operation = graphql(client, CURRENT_BULK_OPERATION)["currentBulkOperation"]
+        if operation["status"] in FINISHED:
+            break
+        if waited >= timeout:
+            raise BulkOperationError(f"Bulk operation {operation['id']} still {operation['status']} after {timeout}s")
+        sleep(poll_interval)
+        waited += poll_interval
+    if operation["status"] != "COMPLETED":
+        raise BulkOperationError(
+            f"Bulk operation {operation['id']} {operation['status']}: {operation.get('errorCode')}"
+        )
+    return operation.get("url")
+
+
+def start_bulk_operation(client, query):
+    result = graphql(client, RUN_BULK_QUERY, {"query": query})["bulkOperationRunQuery"]
+    if result["userErrors"]:
+        # e.g. another bulk operation is still running for the shop
+        raise BulkOperationError("; ".join(error["message"] for error in result["userErrors"]))
+    return result["bulkOperation"]["id"]
+
+
+def graphql(client, query, variables=None):
+    body = client.post("graphql.json", json={"query": query, "variables": variables or {}}).json()
+    if body.get("errors"):
+        raise BulkOperationError(json.dumps(body["errors"]))
+    return body["data"]
+
+
+def iter_lines(url, timeout=60):
+    # the file is on Shopify's storage and is fetched without the shop's token
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield line
+
+
+def read_orders(lines):
+    # REST shaped orders from JSONL lines; an order is complete once the next
+    # order starts, since its line items directly follow it
+    order, line_items = None, []
+    for line in lines:
+        node = json.loads(line)
+        if "__parentId" not in node:
+            if order:
+                yield to_rest_order(order, line_items)
+            order, line_items = node, []
+        elif order and node["__parentId"] == order["id"]:
+            line_items.append(node)
+        else:
+            raise BulkOperationError(f"Line item {node.get('id')} does not follow its order {node['__parentId']}")
+    if order:
+        yield to_rest_order(order, line_items)
+
+
+def iter_batches(orders, size=250):
+    batch = []
+    for order in orders:
+        batch.append(order)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def to_rest_order(order, line_items):
+    customer = order.get("customer")
+    shipping = money((order.get("shippingLine") or {}).get("originalPriceSet"))
+    return {
+        "id": legacy_id(order["id"]),
+        "name": order.get("name"),
+        "created_at": order.get("createdAt"),
+        "updated_at": order.get("updatedAt"),
+        "currency": order.get("currencyCode"),
+        "taxes_included": order.get("taxesIncluded"),
+        "customer": customer and {
+            "id": legacy_id(customer.get("id")),
+            "email": customer.get("email"),
+            "first_name": customer.get("firstName"),
+            "last_name": customer.get("lastName"),
+            "phone": customer.get("phone"),
+            "default_address": to_rest_address(customer.get("defaultAddress")),
+        },
+        "billing_address": to_rest_address(order.get("billingAddress")),
+        "shipping_address": to_rest_address(order.get("shippingAddress")),
+        "line_items": [
+            {
+                "id": legacy_id(item.get("id")),
+                "sku": item.get("sku"),
+                "name": item.get("name"),
+                "price": money(item.get("originalUnitPriceSet")),
+                "quantity": item.get("quantity"),
+                "tax_lines": [
+                    {"title": tax.get("title"), "price": money(tax.get("priceSet")), "rate": tax.get("rate")}
+                    for tax in item.get("taxLines") or []
+                ],
+            }
+            for item in line_items
+        ],
+        "shipping_lines": [{"price": shipping}] if shipping is not None else [],
+        "discount_codes": [
+            {"code": code, "amount": money(order.get("totalDiscountsSet"))}
+            for code in (order.get("discountCodes") or [])[:1]
+        ],
+    }
+
+
+def to_rest_address(address):
+    if not address:
+        return address
+    return {
+        "first_name": address.get("firstName"),
+        "last_name": address.get("lastName"),
+        "address1": address.get("address1"),
+        "address2": address.get("address2"),
+        "city": address.get("city"),
+        "province": address.get("province"),
+        "country": address.get("country"),
+        "zip": address.get("zip"),
+        "phone": address.get("phone"),
+    }
+
+
+def money(value):
+    # {"shopMoney": {"amount": "99.00"}} -> "99.00"
+    if not value:
+        return None
+    return (value.get("shopMoney") or {}).get("amount")
+
+
+def legacy_id(gid):
+    # gid://shopify/Order/5453587153150 -> 5453587153150, the id the REST api uses
+    if not gid:
+        return None
+    return int(str(gid).rsplit("/", 1)[-1])
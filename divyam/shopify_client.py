@@ -0,0 +1,145 @@
+#shared http client for the Shopify admin api
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+API_VERSION = "2021-04"
+CALL_LIMIT_HEADER = "X-Shopify-Shop-Api-Call-Limit"
+
+
+class LeakyBucket:
+    # Client side copy of Shopify's request bucket (40 requests, leaking 2 per
+    # second on standard plans). The level is corrected from the call limit
+    # header of every response, so several threads sharing one bucket stay just
+    # below the limit instead of running into 429s.
+    def __init__(self, size=40, leak_rate=2.0, clock=time.monotonic, sleep=time.sleep):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.level = 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _leak(self):
+        now = self.clock()
+        self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._leak()
+                if self.level + 1 <= self.size - 1:
+                    self.level += 1
+                    return
+                wait = (self.level + 2 - self.size) / self.leak_rate
+            self.sleep(wait)
+
+    def update(self, call_limit):
+        # call_limit looks like "32/40"
+        if not call_limit:
+            return
+        try:
+            used, size = (int(part) for part in call_limit.split("/"))
+        except ValueError:
+            return
+        with self.lock:
+            self._leak()
+            self.size = size
+            self.level = float(used)
+
+
+class ShopifyClient:
+    def __init__(self, shop_url, access_token, api_version=API_VERSION, max_retries=5,
+            timeout=60, backoff=1.0, bucket=None, sleep=time.sleep):
+        if "://" not in shop_url:
+            shop_url = f"https://{shop_url}"
+        self.base_url = f"{shop_url.rstrip('/')}/admin/api/{api_version}"
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.sleep = sleep
+        self.bucket = bucket or LeakyBucket(sleep=sleep)
+
+        # one pooled keep-alive session per shop
+        self.session = requests.Session()
+        self.session.headers.update({
+            "X-Shopify-Access-Token": access_token,
+            "Accept": "application/json",
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path):
+        # accepts "orders.json" as well as the absolute urls found in Link headers
+        if "://" in path:
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path, params=None):
+        return self.request("GET", path, params=params)
+
+    def post(self, path, json=None):
+        return self.request("POST", path, json=json)
+
+    def request(self, method, path, **kwargs):
+        url = self.url(path)
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                self.sleep(self.retry_delay(attempt))
+                attempt += 1
+                continue
+
+            self.bucket.update(response.headers.get(CALL_LIMIT_HEADER))
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt >= self.max_retries:
+                    response.raise_for_status()
+                self.sleep(self.retry_delay(attempt, response.headers.get("Retry-After")))
+                attempt += 1
+                continue
+
+            response.raise_for_status()
+            return response
+
+    def retry_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        # exponential backoff with full jitter
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+
+def parse_json(response):
+    # orjson is several times faster on large order pages when it is installed
+    if orjson:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def get_next_url(response):
+    # Parse the 'Link' header to find the next page URL
+    link_header = response.headers.get('Link')
+    if not link_header:
+        return None
+    for link in link_header.split(','):
+        if 'rel="next"' in link:
+            return link[link.find('<') + 1:link.find('>')]
+    return None
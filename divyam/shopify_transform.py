@@ -0,0 +1,205 @@
+#map Shopify order payloads to Sales Order values
+# Nothing in here touches the database: customers, addresses and items are
+# resolved by the caller beforehand, so the webhook, the poller and the repair
+# jobs all build exactly the same documents.
+from datetime import date, datetime
+
+from frappe.utils import flt
+
+COMPANY = "Doeraa Private Limited"
+WAREHOUSE = "Finished Goods - DPL"
+COST_CENTER = "Main - DPL"
+HOME_STATE = "Gujarat"
+SHIPPING_ITEM = "SHIPPING CHARGES"
+
+# what a Shopify Store row can override; the values of the original store are
+# the defaults for anything it leaves empty
+STORE_DEFAULTS = {
+    "company": COMPANY,
+    "warehouse": WAREHOUSE,
+    "cost_center": COST_CENTER,
+    "home_state": HOME_STATE,
+    "igst_account": "Output Tax IGST - DPL",
+    "cgst_account": "Output Tax CGST - DPL",
+    "sgst_account": "Output Tax SGST - DPL",
+    # currency of the company; the caller fills it in from the Company
+    "currency": "INR",
+}
+
+# the order fields read by this module and the repair jobs; list requests ask
+# Shopify for only these instead of the full order
+ORDER_FIELD_NAMES = (
+    "id",
+    "name",
+    "created_at",
+    "updated_at",
+    "currency",
+    "taxes_included",
+    "customer",
+    "billing_address",
+    "shipping_address",
+    "line_items",
+    "shipping_lines",
+    "discount_codes",
+)
+ORDER_FIELDS = ",".join(ORDER_FIELD_NAMES)
+
+
+def project_order(order):
+    # the top level fields a list request with ORDER_FIELDS returns, so a full
+    # webhook payload and a polled one store and hash the same
+    return {field: order[field] for field in ORDER_FIELD_NAMES if field in order}
+
+
+def get_store_settings(store=None):
+    return {key: (store or {}).get(key) or default for key, default in STORE_DEFAULTS.items()}
+
+
+def build_sales_order(order, customer, address, today, store=None, exchange_rates=None):
+    # exchange_rates maps (currency, transaction date) to the rate into the
+    # company currency, for orders placed in another currency
+    store = get_store_settings(store)
+    transaction_date = get_date(order.get("created_at")) or today
+    currency = order.get("currency") or store["currency"]
+    tax_category = get_tax_category(order, store["home_state"])
+    items = get_items(order, today, store["warehouse"])
+    shipping_item = get_shipping_item(order, today, store["warehouse"])
+    if shipping_item:
+        items.append(shipping_item)
+    return {
+        "doctype": "Sales Order",
+        "company": store["company"],
+        "order_type": "Sales",
+        "currency": currency,
+        "conversion_rate": get_conversion_rate(currency, transaction_date, store["currency"], exchange_rates),
+        "customer": customer,
+        "customer_address": address,
+        "items": items,
+        "tax_category": tax_category,
+        "taxes": get_taxes(order, tax_category, store),
+        "delivery_date": today,
+        "transaction_date": transaction_date,
+        "shopify_order_id": order.get("id"),
+        "shopify_order_number": order.get("name"),
+        "discount_amount": get_discount(order),
+    }
+
+
+def get_items(order, today, warehouse=WAREHOUSE):
+    items = []
+    for item in order.get("line_items", []):
+        gst = index_tax_lines(item)
+        igst = gst.get("IGST", (0, 0))
+        cgst = gst.get("CGST", (0, 0))
+        sgst = gst.get("SGST", (0, 0))
+        items.append({
+            "item_code": item.get("sku"),
+            "item_name": (item.get("name") or "")[:140],
+            "rate": item.get("price"),
+            "qty": item.get("quantity"),
+            "warehouse": warehouse,
+            "delivery_date": today,
+            "uom": "Meter",
+            "gst_treatment": "Taxable",
+            "igs_amount": igst[0],
+            "igs_rate": igst[1],
+            "cgst_amount": cgst[0],
+            "cgst_rate": cgst[1],
+            "sgst_amount": sgst[0],
+            "sgst_rate": sgst[1],
+        })
+    return items
+
+
+def index_tax_lines(item):
+    # title -> (amount, rate) for the first tax line of each title, in one scan
+    taxes = {}
+    for tax_line in item.get("tax_lines") or []:
+        title = tax_line.get("title")
+        if title not in taxes:
+            taxes[title] = (float(tax_line.get("price") or 0), float(tax_line.get("rate") or 0))
+    return taxes
+
+
+def get_shipping_item(order, today, warehouse=WAREHOUSE):
+    shipping_lines = order.get("shipping_lines", [])
+    if not shipping_lines:
+        return None
+    charge = shipping_lines[0].get("price")
+    if flt(charge) <= 0:
+        return None
+    return {
+        "item_code": SHIPPING_ITEM,
+        "item_name": SHIPPING_ITEM,
+        "rate": charge,
+        "qty": 1,
+        "warehouse": warehouse,
+        "delivery_date": today,
+        "uom": "Nos",
+    }
+
+
+def get_discount(order):
+    discount_codes = order.get("discount_codes", [])
+    if discount_codes:
+        return discount_codes[0].get("amount")
+    return 0
+
+
+def get_conversion_rate(currency, transaction_date, company_currency, exchange_rates=None):
+    if currency == company_currency:
+        return 1
+    rate = flt((exchange_rates or {}).get((currency, transaction_date)))
+    if not rate:
+        raise ValueError(f"No exchange rate from {currency} to {company_currency} on {transaction_date}")
+    return rate
+
+
+def get_tax_category(order, home_state=HOME_STATE):
+    province = (order.get("billing_address") or {}).get("province")
+    if province == home_state:
+        return "In-state"
+    return "Out-state"
+
+
+def get_taxes(order, tax_category, store=None):
+    store = store or STORE_DEFAULTS
+    tax_included = order.get("taxes_included")
+    if tax_category == "Out-state":
+        return [
+            {
+                "charge_type": "On Net Total",
+                "account_head": store["igst_account"],
+                "cost_center": store["cost_center"],
+                "rate": 5,
+                "description": "IGST - 5.00%",
+                "included_in_print_rate": tax_included,
+            }
+        ]
+    return [
+        {
+            "charge_type": "On Net Total",
+            "account_head": store["cgst_account"],
+            "cost_center": store["cost_center"],
+            "rate": 2.5,
+            "description": "SGST - 2.50%",
+            "included_in_print_rate": tax_included,
+        },
+        {
+            "charge_type": "On Net Total",
+            "account_head": store["sgst_account"],
+            "cost_center": store["cost_center"],
+            "rate": 2.5,
+            "description": "CGST - 2.50%",
+            "included_in_print_rate": tax_included,
+        },
+    ]
+
+
+def get_date(value):
+    # Shopify timestamps look like 2024-05-01T10:20:30+05:30
+    if not value:
+        return None
+    if isinstance(value, (date, datetime)):
+        return value if type(value) is date else value.date()
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).date()
@@ -0,0 +1,107 @@
+#timing and throughput of Shopify sync runs, stored as Shopify Sync Run records
+import os
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import flt, now
+
+
+class SyncStats:
+    # filled in by the fetch thread (bytes, http, json) and the ingesting thread
+    # (everything else); the two never write the same attribute
+    PHASES = ("http", "json", "master_data", "insert", "commit")
+
+    def __init__(self, run=None):
+        # name of the Shopify Sync Run these figures are written to
+        self.run = run
+        self.pages = 0
+        self.bytes = 0
+        self.orders_seen = 0
+        self.orders_skipped = 0
+        self.orders_created = 0
+        self.orders_failed = 0
+        self.timings = dict.fromkeys(self.PHASES, 0.0)
+        self.started = time.perf_counter()
+        # workers are long lived, so memory is measured against the start of
+        # the run; only sync_run takes the reading
+        self.rss_at_start = None
+
+    @contextmanager
+    def timer(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.perf_counter() - started
+
+    def get_rss_growth(self):
+        rss = get_rss() if self.rss_at_start is not None else None
+        if rss is None:
+            return None
+        return flt((rss - self.rss_at_start) / 1024 / 1024, 1)
+
+    def as_dict(self):
+        elapsed = time.perf_counter() - self.started
+        values = {
+            "pages": self.pages,
+            "bytes_fetched": self.bytes,
+            "orders_seen": self.orders_seen,
+            "orders_skipped": self.orders_skipped,
+            "orders_created": self.orders_created,
+            "orders_failed": self.orders_failed,
+            "total_time": flt(elapsed, 3),
+            "orders_per_second": flt(self.orders_created / elapsed, 2) if elapsed else 0,
+            "rss_growth": self.get_rss_growth(),
+        }
+        for phase, seconds in self.timings.items():
+            values[f"{phase}_time"] = flt(seconds, 3)
+        return values
+
+
+def get_rss():
+    # current resident memory of the process in bytes; the second field of
+    # statm is in pages. None where there is no /proc, e.g. on macOS.
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def start_sync_run(job):
+    # the run is recorded up front so a stuck or long run is visible while it lasts
+    run = frappe.get_doc({
+        "doctype": "Shopify Sync Run",
+        "job": job,
+        "status": "Running",
+        "started_at": now(),
+    })
+    run.insert(ignore_permissions=True)
+    frappe.db.commit()
+    run.stats = SyncStats(run.name)
+    run.stats.rss_at_start = get_rss()
+    return run
+
+
+def finish_sync_run(run, status="Completed", error=None):
+    frappe.db.set_value("Shopify Sync Run", run.name, {
+        "status": status,
+        "finished_at": now(),
+        "error": error,
+        **run.stats.as_dict(),
+    }, update_modified=False)
+    frappe.db.commit()
+
+
+@contextmanager
+def sync_run(job):
+    # with sync_run("divyam.shopify.get_shopify_data") as stats: ...
+    run = start_sync_run(job)
+    try:
+        yield run.stats
+    except Exception:
+        frappe.db.rollback()
+        finish_sync_run(run, "Failed", frappe.get_traceback())
+        raise
+    finish_sync_run(run)
@@ -0,0 +1,86 @@
+import frappe
+from frappe.utils import add_to_date, now
+from frappe.tests.utils import FrappeTestCase
+
+from divyam.order_ledger import (
+	CLAIM_TIMEOUT_MINUTES,
+	MAX_ATTEMPTS,
+	claim_orders,
+	get_due_retries,
+	mark_created,
+	mark_existing,
+	mark_failed,
+	record_received,
+	retry_now,
+)
+
+
+class TestOrderLedger(FrappeTestCase):
+	def test_order_is_claimed_once(self):
+		self.assertEqual(claim_orders(["9100000001", "9100000002"]), {"9100000001", "9100000002"})
+		self.assertEqual(claim_orders(["9100000001", "9100000003"]), {"9100000003"})
+
+	def test_received_and_failed_orders_can_be_claimed(self):
+		record_received(["9100000011"])
+		self.assertEqual(frappe.db.get_value("Shopify Order Ledger", "9100000011", "state"), "Received")
+		self.assertEqual(claim_orders(["9100000011"]), {"9100000011"})
+
+		mark_failed(["9100000011"], "boom")
+		# not before the backoff has run out
+		self.assertEqual(claim_orders(["9100000011"]), set())
+		retry_now("9100000011")
+		self.assertEqual(claim_orders(["9100000011"]), {"9100000011"})
+
+	def test_created_orders_are_not_claimed_again(self):
+		claim_orders(["9100000021"])
+		mark_created("9100000021", "SAL-ORD-TEST-0001")
+		self.assertEqual(claim_orders(["9100000021"]), set())
+		record_received(["9100000021"])
+		self.assertEqual(frappe.db.get_value("Shopify Order Ledger", "9100000021", "state"), "Created")
+
+	def test_failures_back_off_exponentially(self):
+		claim_orders(["9100000031"])
+		mark_failed(["9100000031"], "Traceback ...", "LinkValidationError")
+		first = frappe.db.get_value("Shopify Order Ledger", "9100000031", ["attempts", "next_retry_at", "error_class"], as_dict=True)
+		self.assertEqual((first.attempts, first.error_class), (1, "LinkValidationError"))
+		self.assertNotIn("9100000031", get_due_retries())
+
+		retry_now("9100000031")
+		claim_orders(["9100000031"])
+		mark_failed(["9100000031"], "Traceback ...", "LinkValidationError")
+		second = frappe.db.get_value("Shopify Order Ledger", "9100000031", ["attempts", "next_retry_at"], as_dict=True)
+		self.assertEqual(second.attempts, 2)
+		self.assertGreater(second.next_retry_at, first.next_retry_at)
+
+		# given up on: only retry_now brings it back
+		frappe.db.set_value("Shopify Order Ledger", "9100000031", "next_retry_at", None)
+		self.assertEqual(claim_orders(["9100000031"]), set())
+
+		retry_now("9100000031")
+		self.assertIn("9100000031", get_due_retries())
+
+	def test_existing_sales_order_settles_failed_order(self):
+		claim_orders(["9100000041"])
+		mark_failed(["9100000041"], "boom")
+		retry_now("9100000041")
+		mark_existing(["9100000041"])
+		self.assertEqual(frappe.db.get_value("Shopify Order Ledger", "9100000041", "state"), "Created")
+		self.assertNotIn("9100000041", get_due_retries())
+
+	def test_abandoned_claim_is_retried(self):
+		# claimed by a run that died before marking the order
+		claim_orders(["9100000051"])
+		self.assertNotIn("9100000051", get_due_retries())
+		frappe.db.sql(
+			"UPDATE `tabShopify Order Ledger` SET modified = %s WHERE name = %s",
+			(add_to_date(now(), minutes=-CLAIM_TIMEOUT_MINUTES - 1), "9100000051"),
+		)
+		self.assertIn("9100000051", get_due_retries())
+		self.assertEqual(claim_orders(["9100000051"]), {"9100000051"})
+
+	def test_failure_without_retry_is_final(self):
+		claim_orders(["9100000061"])
+		mark_failed(["9100000061"], "No customer data", "MissingCustomer", retry=False)
+		row = frappe.db.get_value("Shopify Order Ledger", "9100000061", ["attempts", "next_retry_at"], as_dict=True)
+		self.assertEqual((row.attempts, row.next_retry_at), (MAX_ATTEMPTS, None))
+		self.assertNotIn("9100000061", get_due_retries())
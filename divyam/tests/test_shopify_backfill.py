@@ -0,0 +1,44 @@
+from datetime import date
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from divyam.backfill import STALE_WINDOW_SECONDS, get_window_bounds, is_stale, make_windows
+
+
+class TestShopifyBackfill(FrappeTestCase):
+	def test_windows_cover_the_range_once(self):
+		windows = make_windows("2024-01-01", "2024-03-10", 30)
+		self.assertEqual(windows, [
+			(date(2024, 1, 1), date(2024, 1, 30)),
+			(date(2024, 1, 31), date(2024, 2, 29)),
+			(date(2024, 3, 1), date(2024, 3, 10)),
+		])
+
+	def test_single_day(self):
+		self.assertEqual(make_windows("2024-01-01", "2024-01-01", 30), [(date(2024, 1, 1), date(2024, 1, 1))])
+
+	def test_bulk_operation_is_one_window(self):
+		self.assertEqual(
+			make_windows("2023-04-01", "2024-03-31", 30, "Bulk Operation"),
+			[(date(2023, 4, 1), date(2024, 3, 31))],
+		)
+
+	def test_window_whose_job_died_is_stale(self):
+		long_ago = add_to_date(now_datetime(), seconds=-STALE_WINDOW_SECONDS - 60)
+		for status in ("Queued", "Running"):
+			self.assertTrue(is_stale(frappe._dict(status=status, modified=long_ago)))
+			self.assertFalse(is_stale(frappe._dict(status=status, modified=now_datetime())))
+		self.assertFalse(is_stale(frappe._dict(status="Completed", modified=long_ago)))
+
+	def test_window_bounds_follow_the_shop_time_zone(self):
+		self.assertEqual(
+			get_window_bounds("2024-01-01", "2024-01-30"),
+			("2024-01-01T00:00:00+05:30", "2024-01-30T23:59:59+05:30"),
+		)
+		# daylight saving starts on 10 March in New York
+		self.assertEqual(
+			get_window_bounds("2024-03-01", "2024-03-30", "America/New_York"),
+			("2024-03-01T00:00:00-05:00", "2024-03-30T23:59:59-04:00"),
+		)
@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import date
+
+from divyam.benchmarks.orders import make_orders, to_bulk_lines
+from divyam.benchmarks.stand_in import ShopifyStandIn
+from divyam.shopify_bulk import BulkOperationError, export_orders, iter_lines, read_orders
+from divyam.shopify_client import ShopifyClient
+from divyam.shopify_transform import build_sales_order
+
+
+class TestShopifyBulkExport(unittest.TestCase):
+	def setUp(self):
+		self.orders = make_orders(20)
+		self.shop = ShopifyStandIn(self.orders, bulk_polls=2).start()
+		self.sleeps = []
+		self.client = ShopifyClient(self.shop.url, "token", sleep=self.sleeps.append)
+
+	def tearDown(self):
+		self.shop.stop()
+
+	def test_export_builds_the_same_sales_orders_as_rest(self):
+		url = export_orders(self.client, "created_at:>=2024-01-01", poll_interval=5, sleep=self.sleeps.append)
+		self.assertEqual(self.sleeps, [5, 5])
+
+		exported = {order["id"]: order for order in read_orders(iter_lines(url))}
+		self.assertEqual(len(exported), len(self.orders))
+		today = date(2024, 6, 1)
+		for order in self.orders:
+			self.assertEqual(
+				build_sales_order(exported[order["id"]], "Customer", "Address", today),
+				build_sales_order(order, "Customer", "Address", today),
+			)
+			self.assertEqual(exported[order["id"]]["customer"]["id"], order["customer"]["id"])
+
+	def test_serves_a_canned_file(self):
+		with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+			for line in to_bulk_lines(self.orders[0]):
+				f.write(json.dumps(line) + "\n")
+		self.addCleanup(os.unlink, f.name)
+		self.shop.bulk_file = f.name
+
+		url = export_orders(self.client, "created_at:>=2024-01-01", sleep=self.sleeps.append)
+		(order,) = read_orders(iter_lines(url))
+		self.assertEqual(order["id"], self.orders[0]["id"])
+		self.assertEqual(len(order["line_items"]), len(self.orders[0]["line_items"]))
+
+	def test_rejects_a_second_export_while_one_runs(self):
+		self.shop.bulk_status = "RUNNING"
+		with self.assertRaises(BulkOperationError):
+			export_orders(self.client, "created_at:>=2024-01-01", sleep=self.sleeps.append)
@@ -0,0 +1,96 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from divyam.shopify_client import LeakyBucket, ShopifyClient, get_next_url, parse_json
+
+
+class StubShopify(BaseHTTPRequestHandler):
+	# answers /admin/api/<version>/orders.json with two pages and throttles the
+	# first request of every client with a 429
+	def do_GET(self):
+		server = self.server
+		server.requests.append((self.path, self.headers.get("X-Shopify-Access-Token")))
+		if server.throttle:
+			server.throttle -= 1
+			self.send_response(429)
+			self.send_header("Retry-After", "0")
+			self.end_headers()
+			return
+
+		page = 2 if "page_info=2" in self.path else 1
+		body = json.dumps({"orders": [{"id": page}]}).encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.send_header("X-Shopify-Shop-Api-Call-Limit", f"{len(server.requests)}/40")
+		if page == 1:
+			host, port = server.server_address
+			self.send_header("Link", f'<http://{host}:{port}/admin/api/2021-04/orders.json?page_info=2>; rel="next"')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class TestShopifyClient(unittest.TestCase):
+	def setUp(self):
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubShopify)
+		self.server.requests = []
+		self.server.throttle = 0
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		host, port = self.server.server_address
+		self.sleeps = []
+		self.client = ShopifyClient(f"http://{host}:{port}", "token", sleep=self.sleeps.append)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_follows_link_header(self):
+		response = self.client.get("orders.json", params={"limit": 250})
+		self.assertEqual(parse_json(response)["orders"], [{"id": 1}])
+		response = self.client.get(get_next_url(response))
+		self.assertEqual(parse_json(response)["orders"], [{"id": 2}])
+		self.assertIsNone(get_next_url(response))
+		self.assertEqual(self.server.requests[0], ("/admin/api/2021-04/orders.json?limit=250", "token"))
+		self.assertEqual(self.client.bucket.level, 2)
+
+	def test_retries_after_429(self):
+		self.server.throttle = 2
+		response = self.client.get("orders.json")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(len(self.server.requests), 3)
+		self.assertEqual(self.sleeps, [0.0, 0.0])
+
+	def test_gives_up_after_max_retries(self):
+		self.server.throttle = 10
+		self.client.max_retries = 1
+		with self.assertRaises(Exception):
+			self.client.get("orders.json")
+		self.assertEqual(len(self.server.requests), 2)
+
+
+class TestLeakyBucket(unittest.TestCase):
+	def test_waits_when_bucket_is_full(self):
+		now = [0.0]
+		sleeps = []
+
+		def sleep(seconds):
+			sleeps.append(seconds)
+			now[0] += seconds
+
+		bucket = LeakyBucket(size=40, leak_rate=2, clock=lambda: now[0], sleep=sleep)
+		bucket.update("39/40")
+		bucket.acquire()
+		# one request of headroom is kept, so the bucket has to drain to 38 first
+		self.assertEqual(sleeps, [0.5])
+		self.assertEqual(bucket.level, 39)
+
+	def test_ignores_malformed_header(self):
+		bucket = LeakyBucket()
+		bucket.update("garbage")
+		bucket.update(None)
+		self.assertEqual(bucket.level, 0)
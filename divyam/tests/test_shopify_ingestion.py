@@ -0,0 +1,277 @@
+from unittest.mock import MagicMock, patch
+
+import requests
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import getdate
+
+from divyam import api, shopify
+from divyam.benchmarks.orders import make_orders
+from divyam.benchmarks.stand_in import ShopifyStandIn
+from divyam.shopify_client import ShopifyClient
+
+
+def make_order(order_id, shipping="100.00", discount="50.00"):
+	return {
+		"id": order_id,
+		"name": f"#{order_id}",
+		"created_at": "2024-05-01T10:00:00+05:30",
+		"updated_at": "2024-05-01T10:00:00+05:30",
+		"taxes_included": True,
+		"customer": {"id": 1, "first_name": "Test", "last_name": "Customer"},
+		"billing_address": {"province": "Gujarat"},
+		"shipping_address": {"address1": "1 Main Road", "city": "Surat", "province": "Gujarat", "country": "India", "zip": "395001"},
+		"line_items": [
+			{"sku": "SKU-1", "name": "Fabric", "price": "500.00", "quantity": 2, "tax_lines": []},
+		],
+		"shipping_lines": [{"price": shipping}],
+		"discount_codes": [{"amount": discount}],
+	}
+
+
+class TestShopifyIngestion(FrappeTestCase):
+	def create_sales_orders(self, orders):
+		# master data and the database are replaced, only the document built for
+		# each order is inspected
+		docs = []
+		self.mark_failed = MagicMock()
+
+		def get_doc(values):
+			doc = MagicMock()
+			doc.values = values
+			doc.name = f"SO-{values['shopify_order_id']}"
+			docs.append(doc)
+			return doc
+
+		with patch.multiple(
+			shopify,
+			get_existing_order_ids=MagicMock(return_value=set()),
+			create_missing_items=MagicMock(),
+			prefetch_customers=MagicMock(),
+			create_customer=MagicMock(return_value="Test Customer"),
+			get_address=MagicMock(return_value="Test Customer-Shipping"),
+			get_orders_per_commit=MagicMock(return_value=50),
+			get_company_currency=MagicMock(return_value="INR"),
+			claim_orders=MagicMock(side_effect=lambda order_ids: {str(order_id) for order_id in order_ids}),
+			mark_created=MagicMock(),
+			mark_existing=MagicMock(),
+			mark_failed=self.mark_failed,
+		), patch.object(shopify.frappe, "get_doc", side_effect=get_doc), patch.object(
+			shopify.frappe, "db"
+		), patch.object(shopify.frappe, "log_error"):
+			names = shopify.create_sales_order(orders)
+		return names, docs
+
+	def test_one_save_per_order(self):
+		names, docs = self.create_sales_orders([make_order(1), make_order(2)])
+		self.assertEqual(names, ["SO-1", "SO-2"])
+		for doc in docs:
+			self.assertEqual(doc.insert.call_count, 1)
+			self.assertEqual(doc.save.call_count, 0)
+
+	def test_shipping_and_discount_in_initial_document(self):
+		_, (doc,) = self.create_sales_orders([make_order(1)])
+		item_codes = [item["item_code"] for item in doc.values["items"]]
+		self.assertEqual(item_codes, ["SKU-1", "SHIPPING CHARGES"])
+		self.assertEqual(doc.values["discount_amount"], "50.00")
+
+	def test_free_shipping_adds_no_line(self):
+		_, (doc,) = self.create_sales_orders([make_order(1, shipping="0.00")])
+		self.assertEqual([item["item_code"] for item in doc.values["items"]], ["SKU-1"])
+
+	def test_order_without_customer_fails_for_good(self):
+		order = make_order(2)
+		order["customer"] = None
+		names, _ = self.create_sales_orders([make_order(1), order])
+		self.assertEqual(names, ["SO-1"])
+		self.mark_failed.assert_called_once()
+		self.assertEqual(self.mark_failed.call_args.kwargs["retry"], False)
+
+	def test_malformed_order_fails_alone(self):
+		bad_shipping, bad_tax = make_order(2, shipping=None), make_order(3)
+		bad_tax["line_items"][0]["tax_lines"] = [{"title": "IGST", "price": "10.00", "rate": "five"}]
+		names, _ = self.create_sales_orders([make_order(1), bad_shipping, bad_tax, make_order(4)])
+		self.assertEqual(names, ["SO-1", "SO-4"])
+
+
+def set_stores(*shop_urls):
+	settings = frappe.get_single("Divyam Settings")
+	settings.set("stores", [{"shop_url": shop_url, "enabled": 1} for shop_url in shop_urls])
+	settings.save()
+
+
+class TestShopifyClientCache(FrappeTestCase):
+	def setUp(self):
+		set_stores("one.myshopify.com", "two.myshopify.com")
+
+	def test_client_is_rebuilt_when_settings_are_saved(self):
+		client = shopify.get_client()
+		self.assertIs(shopify.get_client(), client)
+		frappe.get_single("Divyam Settings").save()
+		self.assertIsNot(shopify.get_client(), client)
+
+	def test_each_store_has_its_own_client(self):
+		one, two = shopify.get_client("one.myshopify.com"), shopify.get_client("two.myshopify.com")
+		self.assertIsNot(one, two)
+		self.assertIsNot(one.bucket, two.bucket)
+		# the first enabled store is the default
+		self.assertIs(shopify.get_client(), one)
+
+	def test_shop_url_is_normalized(self):
+		set_stores("https://One.myshopify.com/")
+		self.assertEqual(frappe.get_single("Divyam Settings").stores[0].shop_url, "one.myshopify.com")
+		self.assertEqual(shopify.get_store("HTTPS://one.myshopify.com/").shop_url, "one.myshopify.com")
+
+
+class TestWebhookSignature(FrappeTestCase):
+	def setUp(self):
+		settings = frappe.get_single("Divyam Settings")
+		settings.set("stores", [{"shop_url": "one.myshopify.com", "enabled": 1, "webhook_secret": "secret"}])
+		settings.save()
+
+	def verify(self, body, signature, shop_url="one.myshopify.com"):
+		headers = {"X-Shopify-Shop-Domain": shop_url, "X-Shopify-Hmac-Sha256": signature}
+		with patch.object(api.frappe, "request", MagicMock(**{"get_data.return_value": body})), patch.object(
+			api.frappe, "get_request_header", side_effect=headers.get
+		):
+			api.verify_webhook(shop_url)
+
+	def test_signed_body_is_accepted(self):
+		self.verify(b'{"id": 1}', api.sign_webhook("secret", b'{"id": 1}'))
+
+	def test_other_signature_is_rejected(self):
+		with self.assertRaises(frappe.AuthenticationError):
+			self.verify(b'{"id": 1}', api.sign_webhook("other", b'{"id": 1}'))
+		with self.assertRaises(frappe.AuthenticationError):
+			self.verify(b'{"id": 2}', api.sign_webhook("secret", b'{"id": 1}'))
+
+	def test_unknown_shop_is_rejected(self):
+		with self.assertRaises(frappe.ValidationError):
+			self.verify(b'{"id": 1}', api.sign_webhook("secret", b'{"id": 1}'), "other.myshopify.com")
+
+
+class TestSyncLock(FrappeTestCase):
+	def test_lock_taken_over_is_left_alone(self):
+		store = frappe._dict(shop_url="lock-test.myshopify.com")
+		lock = shopify.acquire_sync_lock(store)
+		self.assertIsNone(shopify.acquire_sync_lock(store))
+		# the lock expired and another worker took it
+		frappe.cache().set(lock["key"], "other")
+		self.assertFalse(shopify.refresh_sync_lock(lock))
+		self.assertFalse(shopify.release_sync_lock(lock))
+		self.assertEqual(frappe.safe_decode(frappe.cache().get(lock["key"])), "other")
+		frappe.cache().delete(lock["key"])
+
+		lock = shopify.acquire_sync_lock(store)
+		self.assertTrue(shopify.refresh_sync_lock(lock))
+		self.assertTrue(shopify.release_sync_lock(lock))
+		self.assertIsNone(frappe.cache().get(lock["key"]))
+
+
+class TestRemoveDuplicateItems(FrappeTestCase):
+	def test_keeps_first_line_of_each_item_code(self):
+		sales_order = frappe.get_doc({
+			"doctype": "Sales Order",
+			"items": [
+				{"item_code": "SKU-1", "qty": 1},
+				{"item_code": "SKU-1", "qty": 2},
+				{"item_code": "SKU-1", "qty": 3},
+				{"item_code": "SKU-2", "qty": 4},
+				{"item_code": "SKU-2", "qty": 5},
+			],
+		})
+		self.assertEqual(shopify.remove_duplicate_items(sales_order), 3)
+		self.assertEqual([(item.item_code, item.qty) for item in sales_order.items], [("SKU-1", 1), ("SKU-2", 4)])
+
+
+class TestApplyAdjustments(FrappeTestCase):
+	def test_adds_missing_shipping_and_discount_once(self):
+		sales_order = frappe.get_doc({"doctype": "Sales Order", "items": [{"item_code": "SKU-1", "qty": 2}]})
+		order = make_order(1, shipping="99.00", discount="50.00")
+		self.assertTrue(shopify.apply_adjustments(sales_order, order, True, True, getdate()))
+		self.assertEqual([item.item_code for item in sales_order.items], ["SKU-1", "SHIPPING CHARGES"])
+		self.assertEqual((sales_order.discount_amount, sales_order.apply_discount_on), (50, "Grand Total"))
+		# already applied, nothing left to change
+		self.assertFalse(shopify.apply_adjustments(sales_order, order, True, True, getdate()))
+
+	def test_skips_orders_without_charges(self):
+		sales_order = frappe.get_doc({"doctype": "Sales Order", "items": [{"item_code": "SKU-1", "qty": 2}]})
+		order = make_order(1, shipping="0.00", discount="0.00")
+		self.assertFalse(shopify.apply_adjustments(sales_order, order, True, True, getdate()))
+
+
+class TestAdaptivePolling(FrappeTestCase):
+	def setUp(self):
+		set_stores("one.myshopify.com", "two.myshopify.com")
+		frappe.db.set_single_value("Divyam Settings", {"min_sync_interval": 60, "max_sync_interval": 900})
+		for store in shopify.get_stores():
+			frappe.db.set_value("Shopify Store", store.name, "sync_interval", 240)
+		self.store = shopify.get_store("one.myshopify.com")
+
+	def test_backs_off_when_nothing_is_new(self):
+		self.assertEqual(shopify.schedule_next_sync(self.store, 0), 480)
+		self.assertEqual(shopify.schedule_next_sync(self.store, 0), 900)
+		self.assertEqual(shopify.schedule_next_sync(self.store, 0), 900)
+
+	def test_tightens_when_busy(self):
+		self.assertEqual(shopify.schedule_next_sync(self.store, 3), 120)
+		self.assertEqual(shopify.schedule_next_sync(self.store, shopify.BUSY_SYNC_ORDERS), 60)
+
+	def test_stores_are_scheduled_separately(self):
+		shopify.schedule_next_sync(self.store, 0)
+		self.assertEqual(frappe.db.get_value("Shopify Store", {"shop_url": "two.myshopify.com"}, "sync_interval"), 240)
+
+	def test_dispatcher_queues_one_job_per_due_store(self):
+		with patch.object(shopify.frappe, "enqueue") as enqueue:
+			shopify.schedule_next_sync(self.store, 0)
+			shopify.poll_shopify()
+		self.assertEqual(
+			[call.kwargs["job_id"] for call in enqueue.call_args_list], ["shopify_sync::two.myshopify.com"]
+		)
+
+	def test_run_without_new_orders_backs_off(self):
+		# the second run sees the last order again through the inclusive
+		# updated_at_min, which must not count as a new order
+		created = set()
+		original_get_doc = frappe.get_doc
+
+		def get_doc(*args, **kwargs):
+			if isinstance(args[0], dict) and args[0].get("doctype") == "Sales Order":
+				doc = MagicMock()
+				doc.name = f"SO-{args[0]['shopify_order_id']}"
+				created.add(str(args[0]["shopify_order_id"]))
+				return doc
+			return original_get_doc(*args, **kwargs)
+
+		with ShopifyStandIn(make_orders(3, start=9200000001)) as shop, patch.multiple(
+			shopify,
+			get_client=MagicMock(return_value=ShopifyClient(shop.url, "test")),
+			get_existing_order_ids=MagicMock(side_effect=lambda orders: {str(o.get("id")) for o in orders} & created),
+			create_missing_items=MagicMock(),
+			prefetch_customers=MagicMock(),
+			create_customer=MagicMock(return_value="Test Customer"),
+			get_address=MagicMock(return_value="Test Customer-Shipping"),
+			claim_orders=MagicMock(side_effect=lambda order_ids: {str(order_id) for order_id in order_ids}),
+			mark_created=MagicMock(),
+			mark_existing=MagicMock(),
+			mark_failed=MagicMock(),
+		), patch.object(shopify.frappe, "get_doc", side_effect=get_doc):
+			shopify.get_shopify_data(self.store.name)
+			first = frappe.db.get_value("Shopify Store", self.store.name, ["sync_interval", "last_sync_orders"], as_dict=True)
+			shopify.get_shopify_data(self.store.name)
+			second = frappe.db.get_value("Shopify Store", self.store.name, ["sync_interval", "last_sync_orders"], as_dict=True)
+
+		self.assertEqual((first.sync_interval, first.last_sync_orders), (120, 3))
+		self.assertEqual((second.sync_interval, second.last_sync_orders), (240, 0))
+
+	def test_fetch_error_fails_the_run(self):
+		error = requests.exceptions.HTTPError("401 Client Error: Unauthorized")
+		with patch.object(shopify, "fetch_page", side_effect=error), patch.object(shopify.frappe, "log_error"):
+			with self.assertRaises(requests.exceptions.HTTPError):
+				shopify.get_shopify_data(self.store.name)
+		run = frappe.get_last_doc("Shopify Sync Run")
+		self.assertEqual(run.status, "Failed")
+		# not scheduled as an empty run, so the next tick tries again
+		store = frappe.db.get_value("Shopify Store", self.store.name, ["sync_interval", "next_sync_at"], as_dict=True)
+		self.assertEqual((store.sync_interval, store.next_sync_at), (240, None))
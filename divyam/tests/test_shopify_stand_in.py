@@ -0,0 +1,51 @@
+import unittest
+
+import requests
+
+from divyam.benchmarks.orders import make_orders
+from divyam.benchmarks.stand_in import ShopifyStandIn
+from divyam.shopify_client import ShopifyClient, get_next_url, parse_json
+
+
+class TestShopifyStandIn(unittest.TestCase):
+	def setUp(self):
+		self.orders = make_orders(30)
+		self.shop = ShopifyStandIn(self.orders).start()
+		self.client = ShopifyClient(self.shop.url, "token", sleep=lambda seconds: None)
+
+	def tearDown(self):
+		self.shop.stop()
+
+	def fetch_all(self, params):
+		response = self.client.get("orders.json", params=params)
+		pages = [parse_json(response)["orders"]]
+		while get_next_url(response):
+			response = self.client.get(get_next_url(response))
+			pages.append(parse_json(response)["orders"])
+		return pages
+
+	def test_paginates_through_link_headers(self):
+		pages = self.fetch_all({"limit": 8, "fields": "id,updated_at"})
+		self.assertEqual([len(page) for page in pages], [8, 8, 8, 6])
+		ids = [order["id"] for page in pages for order in page]
+		self.assertEqual(sorted(ids), sorted(order["id"] for order in self.orders))
+		self.assertEqual(set(pages[-1][0]), {"id", "updated_at"})
+
+	def test_filters(self):
+		ids = [str(order["id"]) for order in self.orders[:3]]
+		(page,) = self.fetch_all({"ids": ",".join(ids)})
+		self.assertEqual(sorted(str(order["id"]) for order in page), sorted(ids))
+
+		(page,) = self.fetch_all({"name": self.orders[5]["name"]})
+		self.assertEqual([order["id"] for order in page], [self.orders[5]["id"]])
+
+		(page,) = self.fetch_all({"updated_at_min": "2030-01-01T00:00:00Z"})
+		self.assertEqual(page, [])
+
+	def test_throttles_when_bucket_overflows(self):
+		self.shop.bucket_size = 2
+		self.shop.leak_rate = 0
+		url = self.client.url("orders.json")
+		statuses = [requests.get(url).status_code for _ in range(3)]
+		self.assertEqual(statuses, [200, 200, 429])
+		self.assertEqual(self.shop.throttled, 1)
@@ -0,0 +1,106 @@
+import unittest
+from datetime import date
+
+from divyam.benchmarks.orders import make_order
+from divyam.shopify_transform import (
+	build_sales_order,
+	get_date,
+	index_tax_lines,
+	project_order,
+)
+
+TODAY = date(2024, 6, 1)
+
+
+class TestShopifyTransform(unittest.TestCase):
+	def test_header(self):
+		values = build_sales_order(make_order(2), "CUST-2", "ADDR-2", TODAY)
+		self.assertEqual(values["customer"], "CUST-2")
+		self.assertEqual(values["customer_address"], "ADDR-2")
+		self.assertEqual(values["shopify_order_id"], 2)
+		self.assertEqual((values["order_type"], values["currency"], values["conversion_rate"]), ("Sales", "INR", 1))
+
+	def test_foreign_currency_order(self):
+		order = make_order(1)
+		order["currency"] = "USD"
+		day = get_date(order["created_at"])
+		values = build_sales_order(order, "CUST", None, TODAY, exchange_rates={("USD", day): 83.2})
+		self.assertEqual((values["currency"], values["conversion_rate"]), ("USD", 83.2))
+		# without a rate the order fails instead of being booked at face value
+		with self.assertRaises(ValueError):
+			build_sales_order(order, "CUST", None, TODAY)
+
+	def test_shipping_line_without_price(self):
+		order = make_order(1)
+		order["shipping_lines"] = [{"price": None}, {}]
+		values = build_sales_order(order, "CUST", None, TODAY)
+		self.assertNotIn("SHIPPING CHARGES", [item["item_code"] for item in values["items"]])
+		order["shipping_lines"] = [{}]
+		self.assertNotIn("SHIPPING CHARGES", [item["item_code"] for item in build_sales_order(order, "CUST", None, TODAY)["items"]])
+
+	def test_in_state_order(self):
+		order = make_order(1)
+		order["billing_address"]["province"] = "Gujarat"
+		values = build_sales_order(order, "CUST", None, TODAY)
+		self.assertEqual(values["tax_category"], "In-state")
+		self.assertEqual([tax["account_head"] for tax in values["taxes"]], ["Output Tax CGST - DPL", "Output Tax SGST - DPL"])
+
+	def test_out_of_state_order(self):
+		order = make_order(1)
+		order["billing_address"]["province"] = "Delhi"
+		values = build_sales_order(order, "CUST", None, TODAY)
+		self.assertEqual(values["tax_category"], "Out-state")
+		self.assertEqual([tax["account_head"] for tax in values["taxes"]], ["Output Tax IGST - DPL"])
+
+	def test_store_overrides(self):
+		order = make_order(1)
+		order["billing_address"]["province"] = "Gujarat"
+		order["shipping_lines"] = [{"price": "99.00"}]
+		store = {"company": "Other Company", "warehouse": "Stores - OC", "home_state": "Maharashtra", "igst_account": "IGST - OC"}
+		values = build_sales_order(order, "CUST", None, TODAY, store)
+		self.assertEqual(values["company"], "Other Company")
+		self.assertEqual({item["warehouse"] for item in values["items"]}, {"Stores - OC"})
+		self.assertEqual(values["tax_category"], "Out-state")
+		# fields the store leaves empty keep the defaults
+		self.assertEqual([(tax["account_head"], tax["cost_center"]) for tax in values["taxes"]], [("IGST - OC", "Main - DPL")])
+
+	def test_shipping_and_discount(self):
+		order = make_order(1)
+		order["shipping_lines"] = [{"price": "99.00"}]
+		order["discount_codes"] = [{"amount": "100.00"}]
+		values = build_sales_order(order, "CUST", None, TODAY)
+		self.assertEqual(values["items"][-1]["item_code"], "SHIPPING CHARGES")
+		self.assertEqual(values["items"][-1]["rate"], "99.00")
+		self.assertEqual(values["discount_amount"], "100.00")
+
+		order["shipping_lines"] = [{"price": "0.00"}]
+		order["discount_codes"] = []
+		values = build_sales_order(order, "CUST", None, TODAY)
+		self.assertNotIn("SHIPPING CHARGES", [item["item_code"] for item in values["items"]])
+		self.assertEqual(values["discount_amount"], 0)
+
+	def test_item_gst_fields(self):
+		item = {"tax_lines": [
+			{"title": "CGST", "price": "12.50", "rate": 0.025},
+			{"title": "SGST", "price": "12.50", "rate": 0.025},
+		]}
+		self.assertEqual(index_tax_lines(item), {"CGST": (12.5, 0.025), "SGST": (12.5, 0.025)})
+
+		order = make_order(1, lines=1)
+		order["line_items"][0]["tax_lines"] = item["tax_lines"]
+		row = build_sales_order(order, "CUST", None, TODAY)["items"][0]
+		self.assertEqual((row["cgst_amount"], row["sgst_amount"], row["igs_amount"]), (12.5, 12.5, 0))
+
+	def test_dates(self):
+		self.assertEqual(get_date("2024-05-01T23:30:00+05:30"), date(2024, 5, 1))
+		self.assertEqual(get_date("2024-05-01T10:00:00Z"), date(2024, 5, 1))
+		self.assertIsNone(get_date(None))
+		values = build_sales_order(make_order(1), "CUST", None, TODAY)
+		self.assertEqual(values["delivery_date"], TODAY)
+
+	def test_projected_payload_matches_list_request(self):
+		order = make_order(1)
+		projected = project_order({**order, "note": "gift", "fulfillments": []})
+		self.assertEqual(projected, project_order(order))
+		self.assertNotIn("note", projected)
+		self.assertEqual(projected["line_items"], order["line_items"])